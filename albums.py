@@ -0,0 +1,78 @@
+import asyncio
+import heapq
+import time
+
+ALBUM_QUIET = 0.4  # an album closes this long after its last item arrived
+ALBUM_MAX_WAIT = 3.0  # ...or this long after its first item, whichever is sooner
+MAX_OPEN_ALBUMS = 1000
+
+
+class MediaGroupAggregator:
+    """Collects the items of Telegram albums (media groups) and flushes each album once.
+
+    add() only records the attachment and resets the album's timer; one task
+    pops closed albums off a deadline heap (no scans) and hands each to
+    on_album(user_id, attachments, info), items in arrival order. File paths
+    are not resolved here: /media fetches them from file_id when viewed. At
+    most max_open albums are held; beyond that the oldest is closed early.
+    """
+
+    def __init__(self, on_album, quiet=ALBUM_QUIET, max_wait=ALBUM_MAX_WAIT, max_open=MAX_OPEN_ALBUMS):
+        self.on_album = on_album
+        self.quiet = quiet
+        self.max_wait = max_wait
+        self.max_open = max_open
+        self.albums = {}  # media_group_id -> {'user_id', 'items', 'info', 'first', 'deadline'}
+        self._deadlines = []  # heap of (deadline, media_group_id); stale entries are skipped
+        self._changed = None
+        self._flushing = set()  # running _flush tasks, kept referenced until done
+        self.flushed = 0
+        self.forced = 0
+
+    def add(self, media_group_id, user_id, attachment, info=None):
+        """Record one album item; call from the event loop."""
+        now = time.monotonic()
+        album = self.albums.get(media_group_id)
+        if album is None:
+            if len(self.albums) >= self.max_open:
+                self.forced += 1
+                self._close(next(iter(self.albums)))  # dicts keep insertion order: the oldest album
+            album = {'user_id': user_id, 'items': [], 'info': info, 'first': now}
+            self.albums[media_group_id] = album
+        album['items'].append(attachment)
+        album['deadline'] = min(now + self.quiet, album['first'] + self.max_wait)
+        heapq.heappush(self._deadlines, (album['deadline'], media_group_id))
+        if self._changed is not None:
+            self._changed.set()
+
+    async def run(self):
+        self._changed = asyncio.Event()
+        while True:
+            now = time.monotonic()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, media_group_id = heapq.heappop(self._deadlines)
+                album = self.albums.get(media_group_id)
+                if album is not None and album['deadline'] == deadline:
+                    self._close(media_group_id)
+            self._changed.clear()
+            timeout = self._deadlines[0][0] - now if self._deadlines else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _close(self, media_group_id):
+        album = self.albums.pop(media_group_id)
+        self.flushed += 1
+        task = asyncio.create_task(self._flush(album))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _flush(self, album):
+        try:
+            await self.on_album(album['user_id'], album['items'], album['info'])
+        except Exception as e:
+            print(f"Saving album for user {album['user_id']} failed: {e}")
+
+    def metrics(self):
+        return {'open_albums': len(self.albums), 'flushed': self.flushed, 'forced': self.forced}
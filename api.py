@@ -1,21 +1,53 @@
-import sqlite3
 import asyncio
+import base64
+import contextlib
+import hashlib
+import hmac
+import json
+import mimetypes
 import os
-from flask import Flask, jsonify, request, session, redirect, url_for, flash
+import re
+import signal
+import sqlite3
+from flask import Flask, Response, has_request_context, jsonify, request, send_file, session, redirect, url_for, flash
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room
-from telegram import Update, Bot
+from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
 from threading import Thread
+from werkzeug.serving import make_server
 from config import BOT_TOKEN, DASHBOARD_PASSWORD, CHANNEL_ID, GROUP_INVITE_LINK, CHANNEL_URL
+from config import WEBHOOK_URL, WEBHOOK_SECRET, UPDATE_WORKERS, UPDATE_QUEUE_SIZE
 import datetime
 import traceback
+import uuid
 
-from db import init_db
+from db import (
+    init_db, add_user, count_users, get_user, get_users_page, USER_SORTS,
+    get_chat_history, get_conversations, mark_conversation_read, get_dashboard_stats, get_stats_series,
+    get_attachment, get_profile_photo, get_last_activity, get_last_activities, from_ts, search_messages, set_user_label as db_set_user_label, label_users, get_label_counts,
+    backfill_search as db_backfill_search, convert_legacy_messages as db_convert_legacy_messages, iter_messages, iter_users
+)
+from broadcast import GLOBAL_RATE, BroadcastEngine
+from dispatcher import UpdateDispatcher
+from events import INBOX_ROOM, EventStream, chat_room
+import export
+import importer
+from joins import JoinPipeline
+from invites import InviteLinkPool
+from albums import MediaGroupAggregator
+from mediacache import MediaCache
+from outbox import Outbox
+from ratelimit import TokenBucket
+from presence import PresenceTracker
+from profiles import ProfileCache
+from writer import MessageWriter
+from media import UploadError, cleanup, file_url, message_attachment, send_media, spool_uploads
+import runtime
+from runtime import run_blocking, submit
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CallbackQueryHandler
-from telegram.ext import ChatJoinRequestHandler
+from telegram.ext import CallbackQueryHandler, ChatMemberHandler
 
 from pyrogram import Client, filters as pyro_filters
 from pyrogram.types import ChatJoinRequest
@@ -33,33 +65,9 @@ WELCOME_TEXT = getattr(config, "WELCOME_TEXT", "🎉 Hi {mention}, you are now a
 
 @pyro_app.on_chat_join_request(pyro_filters.chat(CHAT_ID))
 async def approve_and_dm(client, join_request: ChatJoinRequest):
-    user = join_request.from_user
-    chat = join_request.chat
-
-    await client.approve_chat_join_request(chat.id, user.id)
-    print(f"Approved: {user.first_name} ({user.id}) in {chat.title}")
-
-    # Add user to DB (reuse add_user from api.py)
-    from datetime import datetime
-    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-    username = user.username or ''
-    join_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    invite_link = None  # Pyrogram does not provide invite_link in join request
-    add_user(user.id, full_name, username, join_date, invite_link)
-
-    try:
-        await client.send_message(
-            user.id,
-            WELCOME_TEXT.format(mention=user.mention, title=chat.title)
-        )
-        print(f"DM sent to {user.first_name} ({user.id})")
-    except Exception as e:
-        print(f"Failed to send DM to {user.first_name} ({user.id}): {e}")
+    # Approves right away; the user row is saved in a batch and the welcome DM is queued
+    await join_pipeline.handle(join_request)
 
-from telegram import InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaAnimation
-
-from collections import defaultdict
-import time
 
 app = Flask(__name__)
 app.secret_key = 'change_this_secret_key'
@@ -73,190 +81,438 @@ socketio = SocketIO(app, async_mode='threading', cors_allowed_origins=[
     "http://127.0.0.1:3000",
     "http://192.168.1.3:3000"
 ])
-
-DB_NAME = 'users.db'
+# Message, delivery and broadcast events go to chat_<id> / inbox rooms, numbered so clients can resume
+events = EventStream(socketio)
 
 # Ensure DB tables exist
 init_db()
 
-# --- Database helpers ---
-def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users')
-    users = c.fetchall()
-    conn.close()
-    return users
-
-def get_total_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    total = c.fetchone()[0]
-    conn.close()
-    return total
-
-def get_messages_for_user(user_id, limit=100):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT sender, message, timestamp FROM messages WHERE user_id = ? ORDER BY id ASC LIMIT ?', (user_id, limit))
-    messages = c.fetchall()
-    conn.close()
-    return messages
-
-def save_message(user_id, sender, message):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)',
-              (user_id, sender, message, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-    conn.commit()
-    conn.close()
-
-def add_user(user_id, full_name, username, join_date, invite_link, photo_url=None, label=None):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, invite_link, photo_url, label) VALUES (?, ?, ?, ?, ?, ?, ?)', (user_id, full_name, username, join_date, invite_link, photo_url, label))
-    conn.commit()
-    conn.close()
-
-def get_active_users(minutes=60):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    since = (datetime.datetime.now() - datetime.timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-    c.execute('SELECT COUNT(DISTINCT user_id) FROM messages WHERE timestamp >= ?', (since,))
-    count = c.fetchone()[0]
-    conn.close()
-    return count
-
-def get_total_messages():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM messages')
-    count = c.fetchone()[0]
-    conn.close()
-    return count
-
-def get_new_joins_today():
-    today = datetime.datetime.now().strftime('%Y-%m-%d')
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users WHERE join_date LIKE ?', (f'{today}%',))
-    count = c.fetchone()[0]
-    conn.close()
-    return count
-
-def get_user_online_status(user_id, minutes=5):
-    """Check if user has been active in the last N minutes"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    since = (datetime.datetime.now() - datetime.timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-    c.execute('SELECT 1 FROM messages WHERE user_id = ? AND timestamp >= ? LIMIT 1', (user_id, since))
-    is_online = c.fetchone() is not None
-    conn.close()
-    return is_online
+# Online status / last activity, kept in memory and pushed to dashboards as 'presence' events
+# Not numbered or buffered: a reconnecting client refetches /presence instead
+presence = PresenceTracker(on_change=lambda user_id, is_online, last_seen: socketio.emit('presence', {
+    'user_id': user_id,
+    'is_online': is_online,
+    'last_activity': from_ts(last_seen)
+}, to=[INBOX_ROOM, chat_room(user_id)]))
+
+profiles = ProfileCache()
+
+def emit_message(user_id, message):
+    # The persisted message itself, so dashboards append it instead of refetching the chat
+    profile = profiles.peek(user_id)
+    events.emit('new_message', {
+        'user_id': user_id,
+        'full_name': profile['full_name'] if profile else None,
+        'username': profile['username'] if profile else None,
+        'message': public_message(message)
+    }, [chat_room(user_id), INBOX_ROOM])
+
+def messages_saved(rows):
+    # Writer thread, after each committed batch: ids are known now
+    for message_id, (user_id, sender, text, timestamp, ts, kind, payload, attachments) in rows:
+        emit_message(user_id, {'id': message_id, 'sender': sender, 'kind': kind, 'text': text, 'timestamp': timestamp,
+                               'delivery_status': None, 'payload': payload, 'attachments': list(attachments)})
+
+def emit_queued(queued, text):
+    # Outbox messages are inserted by Outbox.enqueue, not the writer
+    emit_message(queued['user_id'], {'id': queued['message_id'], 'sender': 'admin', 'kind': 'text', 'text': text,
+                                     'timestamp': queued['created_at'], 'delivery_status': queued['status'],
+                                     'payload': None, 'attachments': []})
+
+# All message rows go through the write-behind queue
+message_writer = MessageWriter(on_saved=messages_saved)
 
 @app.route('/user-status/<int:user_id>')
 def user_status(user_id):
     """Get user online status and last activity"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Get last message timestamp
-    c.execute('SELECT timestamp FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT 1', (user_id,))
-    last_message = c.fetchone()
-    
     # Check if online (active in last 5 minutes)
-    is_online = get_user_online_status(user_id, 5)
-    
-    # Get user info
-    c.execute('SELECT full_name, username, photo_url FROM users WHERE user_id = ?', (user_id,))
-    user_info = c.fetchone()
-    
-    conn.close()
-    
+    is_online = presence.is_online(user_id)
+    last_activity = presence.get_last_seen(user_id)
+    if last_activity is None:
+        # The tracker only holds users seen in the last day
+        last_activity = get_last_activity(user_id)
+    user_info = get_user(user_id)
+
     return jsonify({
         'user_id': user_id,
-        'full_name': user_info[0] if user_info else '',
-        'username': user_info[1] if user_info else '',
-        'photo_url': user_info[2] if user_info else None,
+        'full_name': user_info[1] if user_info else '',
+        'username': user_info[2] if user_info else '',
+        'photo_url': photo_url(user_info[5]) if user_info else None,
         'is_online': is_online,
-        'last_activity': last_message[0] if last_message else None
+        'last_activity': from_ts(last_activity)
+    })
+
+@app.route('/presence')
+def presence_bulk():
+    # ?ids=1,2,3 -> online flag and last activity for each; memory first, one query for users idle over a day
+    try:
+        user_ids = [int(u) for u in request.args.get('ids', '').split(',') if u.strip()]
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'ids must be a comma separated list of user ids'}), 400
+    if not user_ids:
+        user_ids = presence.online_users()
+    states = presence.bulk(user_ids)
+    stored = get_last_activities([user_id for user_id, (_, last_seen) in states.items() if last_seen is None])
+    return jsonify({
+        str(user_id): {'is_online': is_online, 'last_activity': from_ts(last_seen if last_seen is not None else stored.get(user_id))}
+        for user_id, (is_online, last_seen) in states.items()
     })
 
 # --- Flask API Endpoints ---
+def encode_cursor(sort, key, user_id):
+    return base64.urlsafe_b64encode(json.dumps([sort, key, user_id]).encode()).decode()
+
+def decode_cursor(cursor, sort):
+    cursor_sort, key, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if cursor_sort != sort:
+        raise ValueError('cursor belongs to another sort order')
+    return key, int(user_id)
+
+USER_FILTER_KEYS = ('label', 'q', 'joined_from', 'joined_to', 'invite_link')
+
+def user_filters(args):
+    # label, q (name/username prefix), joined_from / joined_to (YYYY-MM-DD[ HH:MM:SS]), invite_link
+    filters = {
+        'label': args.get('label') or None,
+        'prefix': args.get('q', '').strip() or None,
+        'invite_link': args.get('invite_link') or None
+    }
+    if args.get('joined_from'):
+        filters['joined_from'] = parse_when(args['joined_from'])
+    if args.get('joined_to'):
+        filters['joined_to'] = parse_when(args['joined_to'], end=True)
+    return filters
+
+MAX_USERS_PAGE = 500
+
 @app.route('/dashboard-users')
 def dashboard_users():
-    # Get page and page_size from query params, default page=1, page_size=10
-    page = int(request.args.get('page', 1))
-    page_size = int(request.args.get('page_size', 10))
+    # Get page and page_size from query params, default page=1, page_size=10.
+    # Alternatively pass ?cursor=<next_cursor> from the previous response (keyset pagination).
+    # Filters: see user_filters(); ?sort=join_date|name|username|last_activity&order=desc|asc
+    try:
+        page = int(request.args.get('page', 1))
+        page_size = int(request.args.get('page_size', 10))
+        filters = user_filters(request.args)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid page, page_size, joined_from or joined_to'}), 400
+    if page < 1 or not 1 <= page_size <= MAX_USERS_PAGE:
+        return jsonify({'status': 'error', 'message': f'page must be at least 1 and page_size 1-{MAX_USERS_PAGE}'}), 400
+    sort = request.args.get('sort', 'join_date')
+    order = request.args.get('order', 'desc')
+    if sort not in USER_SORTS or order not in ('asc', 'desc'):
+        return jsonify({'status': 'error', 'message': f"sort must be one of {', '.join(USER_SORTS)} and order asc or desc"}), 400
     offset = (page - 1) * page_size
+    cursor = request.args.get('cursor')
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor, sort)
+        except Exception:
+            return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    total = c.fetchone()[0]
-    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users ORDER BY join_date DESC LIMIT ? OFFSET ?', (page_size, offset))
-    users = c.fetchall()
-    conn.close()
+    # Counter when unfiltered, an index-only COUNT otherwise
+    total = count_users(filters)
+    # Online flag comes back with the page itself: one query, no per-row lookups
+    users = get_users_page(page_size, offset, after=after, filters=filters, sort=sort, descending=order == 'desc')
 
-    # Add online status for each user
     users_with_status = []
     for u in users:
-        is_online = get_user_online_status(u[0], 5)
         users_with_status.append({
-                'user_id': u[0],
-                'full_name': u[1],
-                'username': u[2],
-                'join_date': u[3],
+            'user_id': u[0],
+            'full_name': u[1],
+            'username': u[2],
+            'join_date': u[3],
             'invite_link': u[4],
-            'photo_url': u[5],
-            'is_online': is_online,
-            'label': u[6]
+            'photo_url': photo_url(u[5]),
+            'is_online': bool(u[7]),
+            'labels': sorted(json.loads(u[6]))
         })
 
+    next_cursor = encode_cursor(sort, users[-1][9], users[-1][0]) if len(users) == page_size else None
     return jsonify({
         'users': users_with_status,
         'total': total,
         'page': page,
-        'page_size': page_size
+        'page_size': page_size,
+        'next_cursor': next_cursor
     })
 
 @app.route('/dashboard-stats')
 def dashboard_stats():
-    # Total users in the database
-    total_users = get_total_users()
-    # Active users: users who sent messages in the last 60 minutes
-    active_users = get_active_users()  # last 60 minutes
-    # Total messages sent (all time)
-    total_messages = get_total_messages()
-    # New joins today
-    new_joins_today = get_new_joins_today()
+    # Read from counters/rollups maintained at write time; no table scans per poll
+    return jsonify(get_dashboard_stats())
+
+@app.route('/dashboard-stats/series')
+def dashboard_stats_series():
+    bucket = request.args.get('bucket', 'minute')
+    if bucket not in ('minute', 'day'):
+        return jsonify({'status': 'error', 'message': 'bucket must be minute or day'}), 400
+    # since: epoch seconds for minute buckets, YYYY-MM-DD for day buckets
+    since = request.args.get('since')
+    try:
+        if since is not None and bucket == 'minute':
+            since = int(since)
+        elif since is not None:
+            since = datetime.date.fromisoformat(since).isoformat()
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'since must be epoch seconds (minute) or YYYY-MM-DD (day)'}), 400
+    rows = get_stats_series(bucket, since)
     return jsonify({
-        'total_users': total_users,
-        'active_users': active_users,
-        'total_messages': total_messages,
-        'new_joins_today': new_joins_today
+        'bucket': bucket,
+        'series': [{'bucket': b, 'messages': m, 'joins': j} for b, m, j in rows]
     })
 
+HISTORY_PAGE = 50
+MAX_HISTORY_PAGE = 200
+
 @app.route('/chat/<int:user_id>/messages')
 def chat_messages(user_id):
-    messages = get_messages_for_user(user_id)
-    # messages is a list of (sender, message, timestamp)
-    return jsonify([
-        [sender, message, timestamp] for sender, message, timestamp in messages
-    ])
+    # Newest first, HISTORY_PAGE at a time. ?before_id=<oldest_id> pages back,
+    # ?after_id=<newest_id> returns only what arrived since (e.g. after a new_message event).
+    # has_more says whether another page exists in the requested direction.
+    try:
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE)), 1), MAX_HISTORY_PAGE)
+        before_id = int(request.args['before_id']) if request.args.get('before_id') else None
+        after_id = int(request.args['after_id']) if request.args.get('after_id') else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'limit, before_id and after_id must be integers'}), 400
+    if before_id is not None and after_id is not None:
+        return jsonify({'status': 'error', 'message': 'Pass before_id or after_id, not both'}), 400
+    # Make sure rows still sitting in the write-behind queue are visible
+    message_writer.flush()
+    messages, has_more = get_chat_history(user_id, limit, before_id=before_id, after_id=after_id)
+    # A page only changes when messages are added to it or their delivery status moves on
+    etag = hashlib.sha1(json.dumps([has_more] + [[m['id'], m['kind'], m['delivery_status']] for m in messages]).encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        # Typed messages: kind is text/image/video/voice/audio/gif/album, media is in attachments.
+        # delivery_status is queued/sent/failed for admin messages sent through the outbox, None otherwise
+        response = jsonify({
+            'messages': [public_message(m) for m in messages],
+            'has_more': has_more,
+            'oldest_id': messages[-1]['id'] if messages else before_id,
+            'newest_id': messages[0]['id'] if messages else after_id
+        })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+DEFAULT_ADMIN = 'default'
+INBOX_PAGE = 50
+MAX_INBOX_PAGE = 200
+
+def admin_name(req):
+    # Unread counts are per admin; a dashboard identifies itself with X-Admin or ?admin=
+    return req.headers.get('X-Admin') or req.args.get('admin') or DEFAULT_ADMIN
+
+@app.route('/conversations')
+def conversations():
+    # Inbox: chats by latest message, with last message preview and unread count, from one indexed query.
+    # Pass ?before=<next_before> from the previous response for the next page.
+    try:
+        limit = min(max(int(request.args.get('limit', INBOX_PAGE)), 1), MAX_INBOX_PAGE)
+        before = int(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'limit and before must be integers'}), 400
+    message_writer.flush()
+    rows = get_conversations(admin_name(request), limit, before=before)
+    for row in rows:
+        row['photo_url'] = photo_url(row.pop('photo_unique_id'))
+    return jsonify({
+        'conversations': rows,
+        'next_before': rows[-1]['last_message']['id'] if len(rows) == limit else None
+    })
+
+@app.route('/conversations/<int:user_id>/read', methods=['POST'])
+def conversation_read(user_id):
+    admin = admin_name(request)
+    message_writer.flush()
+    if not mark_conversation_read(admin, user_id):
+        return jsonify({'status': 'error', 'message': 'Conversation not found'}), 404
+    # Other open dashboards of the same admin clear the badge too
+    events.emit('conversation_read', {'user_id': user_id, 'admin': admin}, INBOX_ROOM)
+    return jsonify({'status': 'ok', 'user_id': user_id, 'unread': 0})
+
+SEARCH_PAGE = 20
+MAX_SEARCH_PAGE = 100
+
+def fts_query(text):
+    # Plain words, all required, the last one as a prefix: no FTS5 syntax errors from user input
+    terms = ['"' + t.replace('"', '""') + '"' for t in text.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def parse_when(text, end=False):
+    # 'YYYY-MM-DD HH:MM:SS' or a whole day 'YYYY-MM-DD' (inclusive as an end date)
+    try:
+        return int(datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S').timestamp())
+    except ValueError:
+        day = datetime.datetime.strptime(text, '%Y-%m-%d')
+        return int((day + datetime.timedelta(days=1 if end else 0)).timestamp())
+
+@app.route('/search')
+def search():
+    # ?q=words [&user_id=&sender=user|admin&since=&until=&kind=text,image&order=rank|recent&limit=&cursor=]
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'status': 'error', 'message': 'Missing q'}), 400
+    order = request.args.get('order', 'rank')
+    if order not in ('rank', 'recent'):
+        return jsonify({'status': 'error', 'message': 'order must be rank or recent'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE)), 1), MAX_SEARCH_PAGE)
+        user_id = int(request.args['user_id']) if request.args.get('user_id') else None
+        since = parse_when(request.args['since']) if request.args.get('since') else None
+        until = parse_when(request.args['until'], end=True) if request.args.get('until') else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid limit, user_id, since or until'}), 400
+    cursor = request.args.get('cursor')
+    after = None
+    if cursor:
+        try:
+            after = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            after = int(after) if order == 'recent' else (float(after[0]), int(after[1]))
+        except Exception:
+            return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+    kinds = [k for k in request.args.get('kind', '').split(',') if k]
+    message_writer.flush()
+    try:
+        results = search_messages(fts_query(q), user_id=user_id, sender=request.args.get('sender') or None,
+                                  since=since, until=until, kinds=kinds, order=order, after=after, limit=limit)
+    except sqlite3.OperationalError as e:
+        return jsonify({'status': 'error', 'message': f'Search failed: {e}'}), 400
+    next_cursor = None
+    if len(results) == limit:
+        last = results[-1]
+        position = last['id'] if order == 'recent' else [last['rank'], last['id']]
+        next_cursor = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+    return jsonify({'results': results, 'next_cursor': next_cursor})
+
+def export_response(chunks, columns, name):
+    # ?format=csv|ndjson&gzip=1; rows are read, encoded and sent a chunk at a time
+    fmt = request.args.get('format', 'csv')
+    compress = request.args.get('gzip') in ('1', 'true')
+    filename = f"{name}.{fmt}" + ('.gz' if compress else '')
+    return Response(export.stream(chunks, columns, fmt, compress),
+                    mimetype='application/gzip' if compress else export.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'})
+
+@app.route('/export/users')
+def export_users():
+    # Same filters as /dashboard-users
+    if request.args.get('format', 'csv') not in export.FORMATS:
+        return jsonify({'status': 'error', 'message': f"format must be one of {', '.join(export.FORMATS)}"}), 400
+    try:
+        filters = user_filters(request.args)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid joined_from or joined_to'}), 400
+    return export_response(iter_users(filters), export.USER_COLUMNS, 'users')
+
+@app.route('/export/messages')
+def export_messages():
+    # Optional user_id and since/until (YYYY-MM-DD[ HH:MM:SS]), oldest first
+    if request.args.get('format', 'csv') not in export.FORMATS:
+        return jsonify({'status': 'error', 'message': f"format must be one of {', '.join(export.FORMATS)}"}), 400
+    try:
+        user_id = int(request.args['user_id']) if request.args.get('user_id') else None
+        since = parse_when(request.args['since']) if request.args.get('since') else None
+        until = parse_when(request.args['until'], end=True) if request.args.get('until') else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid user_id, since or until'}), 400
+    message_writer.flush()
+    name = f'messages_{user_id}' if user_id is not None else 'messages'
+    return export_response(iter_messages(user_id, since, until), export.MESSAGE_COLUMNS, name)
+
+def media_url(attachment):
+    # Served through /media so the bot token never reaches the browser and files are cached locally
+    if attachment.get('file_unique_id'):
+        endpoint, values = 'media_file', {'file_unique_id': attachment['file_unique_id']}
+    elif attachment.get('id') is not None:
+        endpoint, values = 'legacy_media_file', {'attachment_id': attachment['id']}
+    else:
+        return None
+    if has_request_context():
+        return url_for(endpoint, _external=True, **values)
+    # Socket events are built outside any request: a path relative to this API
+    return app.url_map.bind('').build(endpoint, values)
+
+def public_message(message):
+    message['attachments'] = [{
+        'kind': a['kind'],
+        'file_id': a.get('file_id'),
+        'file_unique_id': a.get('file_unique_id'),
+        'file_size': a.get('file_size'),
+        'mime_type': a.get('mime_type'),
+        'url': media_url(a)
+    } for a in message['attachments']]
+    return message
+
+media_cache = MediaCache()
+app.use_x_sendfile = getattr(config, 'MEDIA_X_SENDFILE', False)
+FILE_UNIQUE_ID = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+@app.route('/media/<file_unique_id>')
+def media_file(file_unique_id):
+    attachment = get_attachment(file_unique_id=file_unique_id) if FILE_UNIQUE_ID.match(file_unique_id) else None
+    if attachment is None:
+        return jsonify({'status': 'error', 'message': 'Media not found'}), 404
+    return serve_media(file_unique_id, attachment)
+
+@app.route('/media/photo/<file_unique_id>')
+def profile_photo(file_unique_id):
+    file_id = get_profile_photo(file_unique_id) if FILE_UNIQUE_ID.match(file_unique_id) else None
+    if file_id is None:
+        return jsonify({'status': 'error', 'message': 'Photo not found'}), 404
+    return serve_media(file_unique_id, {'file_id': file_id, 'file_path': None, 'mime_type': 'image/jpeg'})
+
+def photo_url(file_unique_id):
+    # Per photo, not per user: a new picture gets a new URL, so the old one can be cached forever
+    return url_for('profile_photo', file_unique_id=file_unique_id, _external=True) if file_unique_id else None
+
+@app.route('/media/legacy/<int:attachment_id>')
+def legacy_media_file(attachment_id):
+    attachment = get_attachment(attachment_id=attachment_id)
+    if attachment is None or not attachment['file_path']:
+        return jsonify({'status': 'error', 'message': 'Media not found'}), 404
+    return serve_media(f'legacy-{attachment_id}', attachment)
+
+def serve_media(name, attachment):
+    def resolve():
+        # file_id -> fresh download path only on a cache miss
+        if attachment['file_id']:
+            return file_url(submit(bot.get_file(attachment['file_id'])).result(timeout=30).file_path)
+        return file_url(attachment['file_path'])
+
+    try:
+        path = media_cache.get(name, resolve)
+    except Exception as e:
+        print(f"Could not fetch media {name}: {e}")
+        return jsonify({'status': 'error', 'message': 'Could not fetch media from Telegram'}), 502
+    mimetype = attachment['mime_type'] or mimetypes.guess_type(attachment['file_path'] or '')[0] or 'application/octet-stream'
+    # Conditional + Range requests (video scrubbing) are answered by send_file from the cached file
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=name, max_age=31536000)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/metrics/media')
+def media_metrics():
+    return jsonify(media_cache.metrics())
 
 @app.route('/get_channel_invite_link', methods=['GET'])
 def get_channel_invite_link():
     try:
-        future = asyncio.run_coroutine_threadsafe(
+        future = submit(
             bot.create_chat_invite_link(
                 chat_id=CHANNEL_ID,
                 name=f"AdminPanelInvite-{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-            ),
-            loop
+            )
         )
-        chat = future.result()
+        chat = future.result(timeout=30)
         invite_link = chat.invite_link
         return jsonify({'invite_link': invite_link})
     except Exception as e:
@@ -264,142 +520,51 @@ def get_channel_invite_link():
         return jsonify({'error': str(e)}), 500
 
 # --- Telegram Bot Handlers ---
-bot = Bot(BOT_TOKEN)
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
+# PTB, Pyrogram and the background engines all run on runtime.loop (see serve())
+application = ApplicationBuilder().token(BOT_TOKEN).build()
+bot = application.bot
 
-# In-memory cache for media groups: {media_group_id: {'user_id': ..., 'media': [...], 'type': ..., 'timestamp': ...}}
-media_group_cache = defaultdict(dict)
-MEDIA_GROUP_TIMEOUT = 20  # seconds
+# One global send budget shared by broadcasts and the outbox
+telegram_bucket = TokenBucket(GLOBAL_RATE)
+# One coalesced progress event per broadcast per second, to the inbox only
+broadcaster = BroadcastEngine(bot, on_progress=lambda p: events.emit('broadcast_progress', p, INBOX_ROOM), bucket=telegram_bucket)
+outbox = Outbox(bot, bucket=telegram_bucket,
+                on_update=lambda o: events.emit('delivery', o, chat_room(o['user_id'])))
+invite_pool = InviteLinkPool(bot, CHANNEL_ID, CHANNEL_URL)
+join_pipeline = JoinPipeline(pyro_app, WELCOME_TEXT, bucket=telegram_bucket,
+                             bulk_links=getattr(config, 'BULK_APPROVE_LINKS', ()), invites=invite_pool)
 
-async def cleanup_media_groups():
-    while True:
-        now = time.time()
-        to_delete = []
-        for group_id, group in media_group_cache.items():
-            if now - group.get('timestamp', now) > MEDIA_GROUP_TIMEOUT:
-                to_delete.append(group_id)
-        for group_id in to_delete:
-            print(f"Cleaning up expired media group: {group_id}")
-            del media_group_cache[group_id]
-        await asyncio.sleep(10)
-
-# Start cleanup task (only once)
-if not hasattr(asyncio, '_media_group_cleanup_started'):
-    try:
-        loop = asyncio.get_event_loop()
-        loop.create_task(cleanup_media_groups())
-        asyncio._media_group_cleanup_started = True
-    except Exception as e:
-        print('Could not start media group cleanup:', e)
+async def save_album(user_id, attachments, info):
+    kind = 'album' if len(attachments) > 1 else attachments[0]['kind']
+    await message_writer.save_async(user_id, 'user', '', kind=kind, payload={'media_group_id': info['media_group_id']},
+                                    attachments=attachments)
+    print(f"Saved media group of {len(attachments)} for user {user_id}")
+
+media_groups = MediaGroupAggregator(save_album)
 
 async def user_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user is None:
         return
-    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-    username = user.username or ''
-    join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # Fetch profile photo URL
-    photo_url = None
-    try:
-        photos = await context.bot.get_user_profile_photos(user.id, limit=1)
-        if photos.total_count > 0:
-            file = await context.bot.get_file(photos.photos[0][0].file_id)
-            photo_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-    except Exception as e:
-        print(f"Could not fetch profile photo for user {user.id}: {e}")
-    add_user(user.id, full_name, username, join_date, None, photo_url)
+    presence.touch(user.id)
+    # Name/username upsert only when changed; the profile photo refreshes in the background
+    await profiles.observe(context.bot, user)
 
     message = update.message
+    kind, attachment = message_attachment(message)
     media_group_id = getattr(message, 'media_group_id', None)
-    media_type = None
-    file_id = None
-    if message.photo:
-        media_type = 'image'
-        file_id = message.photo[-1].file_id
-    elif message.video:
-        media_type = 'video'
-        file_id = message.video.file_id
-    elif message.voice:
-        media_type = 'voice'
-        file_id = message.voice.file_id
-    elif message.audio:
-        media_type = 'audio'
-        file_id = message.audio.file_id
-    elif message.animation:
-        media_type = 'gif'
-        file_id = message.animation.file_id
-
-    if media_group_id and media_type in ['image', 'video', 'voice', 'gif']:
-        group = media_group_cache.get(media_group_id)
-        if not group:
-            group = {
-                'user_id': user.id,
-                'media': [],
-                'type': media_type,
-                'timestamp': time.time()
-            }
-            media_group_cache[media_group_id] = group
-        file = await context.bot.get_file(file_id)
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        group['media'].append(file_url)
-        group['timestamp'] = time.time()
-        async def process_group_later(group_id, expected_count=len(group['media'])):
-            await asyncio.sleep(1.5)
-            group = media_group_cache.get(group_id)
-            if group and len(group['media']) == expected_count:
-                label = {'image': '[images]', 'video': '[videos]', 'voice': '[voices]', 'gif': '[gifs]'}[group['type']]
-                save_message(group['user_id'], 'user', f"{label}" + '\n' + '\n'.join(group['media']))
-                print(f"Saved media group {group_id} for user {group['user_id']}: {group['media']}")
-                del media_group_cache[group_id]
-                socketio.emit('new_message', {'user_id': group['user_id'], 'full_name': full_name, 'username': username})
-        loop = asyncio.get_event_loop()
-        loop.create_task(process_group_later(media_group_id, len(group['media'])))
+
+    if media_group_id and attachment is not None:
+        # Saved once the album is complete (see MediaGroupAggregator)
+        media_groups.add(media_group_id, user.id, attachment, {'media_group_id': media_group_id})
         return
 
-    if message.photo:
-        file = await context.bot.get_file(message.photo[-1].file_id)
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[image]{file_url}")
-    elif message.video:
-        file = await context.bot.get_file(message.video.file_id)
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[video]{file_url}")
-    elif message.voice:
-        file = await context.bot.get_file(message.voice.file_id)
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[voice]{file_url}")
-    elif message.audio:
-        file = await context.bot.get_file(message.audio.file_id)
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[audio]{file_url}")
-    elif message.animation:
-        file = await context.bot.get_file(message.animation.file_id)
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[gif]{file_url}")
+    if attachment is not None:
+        # The file path is resolved lazily by /media when someone views it
+        await message_writer.save_async(user.id, 'user', message.caption or '', kind=kind, attachments=[attachment])
     elif message.text:
-        save_message(user.id, 'user', message.text)
-
-    socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
+        await message_writer.save_async(user.id, 'user', message.text)
+    # 'new_message' goes out once the writer has committed the row (messages_saved)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -408,20 +573,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
     username = user.username or ''
     join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # Try to generate a unique invite link for this user
-    invite_link = None
-    try:
-        chat = await context.bot.create_chat_invite_link(
-            chat_id=CHANNEL_ID,
-            member_limit=1,
-            name=f"{full_name} ({user.id})"
-        )
-        invite_link = chat.invite_link
-    except Exception as e:
-        print(f"Failed to create unique invite link: {e}")
-        from config import CHANNEL_URL
-        invite_link = CHANNEL_URL
-    add_user(user.id, full_name, username, join_date, invite_link)
+    # The user's earlier unused link, or a fresh single-use one from the pre-minted pool
+    invite_link = await invite_pool.get_link(user.id)
+    await run_blocking(add_user, user.id, full_name, username, join_date, invite_link)
     keyboard = [
         [InlineKeyboardButton('Join Channel', url=invite_link)],
         [InlineKeyboardButton('I have joined', callback_data='joined_channel')]
@@ -452,21 +606,100 @@ async def channel_joined_callback(update: Update, context: ContextTypes.DEFAULT_
     except Exception:
         pass
 
-async def approve_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.chat_join_request.approve()
-    user = update.chat_join_request.from_user
-    # Store user info in DB
-    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-    username = user.username or ''
-    join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    invite_link = update.chat_join_request.invite_link.invite_link if update.chat_join_request.invite_link else None
-    add_user(user.id, full_name, username, join_date, invite_link)
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Pool links are single-use (member_limit=1), which rules out join requests: joins through them
+    # only show up here, with the link they came in by
+    member = update.chat_member
+    if member is None or member.invite_link is None:
+        return
+    if member.new_chat_member.status in ('member', 'administrator') and member.old_chat_member.status in ('left', 'kicked'):
+        await run_blocking(invite_pool.record_joins, [(member.invite_link.invite_link, member.new_chat_member.user.id)])
+
+async def process_update(data):
+    await application.process_update(Update.de_json(data, application.bot))
+
+# Webhook updates: bounded queue, parallel across users, in order per user
+update_dispatcher = UpdateDispatcher(process_update, workers=UPDATE_WORKERS, max_queue=UPDATE_QUEUE_SIZE)
+WEBHOOK_PATH = '/telegram/webhook'
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not WEBHOOK_SECRET or not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'update_id' not in data:
+        return jsonify({'status': 'error', 'message': 'Invalid update'}), 400
     try:
-        await context.bot.send_message(user.id, "🎉 Welcome! You are now a member. Feel free to chat with me.")
+        accepted = runtime.call(update_dispatcher.put_nowait, data)
     except Exception as e:
-        print(f"Failed to send welcome message: {e}")
+        print(f"Could not queue update {data.get('update_id')}: {e}")
+        accepted = False
+    if not accepted:
+        # Telegram redelivers on non-2xx responses
+        return jsonify({'status': 'error', 'message': 'Update queue is full'}), 503
+    return jsonify({'status': 'ok'})
+
+@app.route('/metrics/joins')
+def join_metrics():
+    return jsonify(join_pipeline.metrics())
+
+@app.route('/metrics/albums')
+def album_metrics():
+    return jsonify(media_groups.metrics())
+
+@app.route('/metrics/invites')
+def invite_metrics():
+    return jsonify(invite_pool.metrics())
+
+@app.route('/metrics/updates')
+def update_metrics():
+    return jsonify(update_dispatcher.metrics())
+
+# Join requests are handled by the Pyrogram client (approve_and_dm); registering a PTB
+# ChatJoinRequestHandler as well would approve and welcome every user twice.
+application.add_handler(CommandHandler('start', start))
+application.add_handler(CallbackQueryHandler(channel_joined_callback, pattern='^joined_channel$'))
+application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+application.add_handler(MessageHandler(
+    (filters.TEXT | filters.PHOTO | filters.VIDEO | filters.VOICE | filters.AUDIO | filters.ANIMATION) & ~filters.COMMAND,
+    user_message_handler
+))
 
 # --- ADMIN GIF SUPPORT ---
+MEDIA_SEND_TIMEOUT = 600
+MEDIA_JOBS_KEPT = 500
+media_jobs = {}
+
+async def media_job(job_id, user_id, tmp_dir, by_kind):
+    try:
+        sent_media, error = await send_media(bot, user_id, by_kind), None
+    except Exception as e:
+        sent_media, error = None, e
+    # Removing the spool and queueing rows can block: off the event loop
+    await run_blocking(finish_media_job, job_id, user_id, tmp_dir, sent_media, error)
+
+def finish_media_job(job_id, user_id, tmp_dir, sent_media, error):
+    cleanup(tmp_dir)
+    job = media_jobs.get(job_id, {'job_id': job_id, 'user_id': user_id})
+    if error is not None:
+        print(f"Telegram file send error (job {job_id}): {error}")
+        job.update(status='error', message=f'Failed to send media: {str(error)}')
+    else:
+        for attachment in sent_media:
+            message_writer.save(user_id, 'admin', '', kind=attachment['kind'], attachments=[attachment])
+        job.update(status='success', sent=len(sent_media))
+    while len(media_jobs) > MEDIA_JOBS_KEPT:
+        media_jobs.pop(next(iter(media_jobs)))
+    events.emit('media_sent', job, chat_room(user_id))
+
+@app.route('/media-jobs/<job_id>')
+def media_job_status(job_id):
+    job = media_jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    return jsonify(job)
+
 @app.route('/chat/<int:user_id>', methods=['POST'])
 def chat_send(user_id):
     message = request.form.get('message')
@@ -477,265 +710,334 @@ def chat_send(user_id):
             files = [single_file]
     print('Incoming request.form keys:', list(request.form.keys()))
     print('Incoming request.files keys:', list(request.files.keys()))
-    sent = False
     response = {'status': 'error', 'message': 'No message or files sent'}
     message_handled = False
-    file_handled = False
 
     if message:
-        save_message(user_id, 'admin', message)
-        try:
-            asyncio.run_coroutine_threadsafe(
-                bot.send_message(chat_id=int(user_id), text=message), loop
-            )
-            sent = True
-            response = {'status': 'success', 'message': 'Message sent'}
-            message_handled = True
-        except Exception as e:
-            print(f"Telegram send error: {e}")
-            response = {'status': 'error', 'message': str(e)}
+        queued, created = outbox.enqueue(int(user_id), message, idempotency_key(request))
+        response = {'status': 'success', 'message': 'Message queued', 'outbox_id': queued['outbox_id'],
+                    'delivery_status': queued['status'], 'duplicate': not created}
+        message_handled = True
+        if created:
+            emit_queued(queued, message)
 
     if files and len(files) > 0:
-        images = []
-        videos = []
-        audios = []
-        gifs = []
-        temp_paths = []
-        MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
-        MAX_PHOTO_SIZE = 20 * 1024 * 1024  # 20MB
-        for file in files:
-            filename = file.filename
-            mimetype = file.mimetype
-            print('File received:', filename, mimetype)
-            file.seek(0, 2)
-            file_size = file.tell()
-            file.seek(0)
-            if mimetype == 'image/gif':
-                gifs.append(InputMediaAnimation(open(f'temp_{filename}', 'rb')))
-            elif mimetype.startswith('image/') and file_size > MAX_PHOTO_SIZE:
-                return jsonify({'status': 'error', 'message': f'Image {filename} is too large. Maximum size is 20MB.'}), 400
-            elif file_size > MAX_FILE_SIZE:
-                return jsonify({'status': 'error', 'message': f'File {filename} is too large. Maximum size is 50MB.'}), 400
-            temp_path = f'temp_{filename}'
-            file.save(temp_path)
-            temp_paths.append(temp_path)
-            if mimetype.startswith('image/') and mimetype != 'image/gif':
-                images.append(InputMediaPhoto(open(temp_path, 'rb')))
-            elif mimetype.startswith('video/'):
-                videos.append(InputMediaVideo(open(temp_path, 'rb')))
-            elif mimetype.startswith('audio/'):
-                audios.append(InputMediaAudio(open(temp_path, 'rb')))
         try:
-            if gifs:
-                if len(gifs) > 1:
-                    print('Sending media group (gifs)...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_media_group(chat_id=int(user_id), media=gifs), loop
-                    )
-                    result = fut.result()
-                    for i, msg in enumerate(result):
-                        if msg.animation:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(msg.animation.file_id), loop
-                            ).result()
-                            if file.file_path.startswith('http'):
-                                file_url = file.file_path
-                            else:
-                                file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                            save_message(user_id, 'admin', f'[gif]{file_url}')
-                else:
-                    print('Sending single gif...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_animation(chat_id=int(user_id), animation=gifs[0].media), loop
-                    )
-                    result = fut.result()
-                    if result.animation:
-                        file = asyncio.run_coroutine_threadsafe(
-                            bot.get_file(result.animation.file_id), loop
-                        ).result()
-                        if file.file_path.startswith('http'):
-                            file_url = file.file_path
-                        else:
-                            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                        save_message(user_id, 'admin', f'[gif]{file_url}')
-                sent = True
-                file_handled = True
-            if images:
-                if len(images) > 1:
-                    print('Sending media group (images)...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_media_group(chat_id=int(user_id), media=images), loop
-                    )
-                    result = fut.result()
-                    for i, msg in enumerate(result):
-                        if msg.photo:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(msg.photo[-1].file_id), loop
-                            ).result()
-                            if file.file_path.startswith('http'):
-                                file_url = file.file_path
-                            else:
-                                file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                            print(f"Debug - file.file_path: {file.file_path}")
-                            print(f"Debug - constructed URL: {file_url}")
-                            save_message(user_id, 'admin', f'[image]{file_url}')
-                else:
-                    print('Sending single image...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_photo(chat_id=int(user_id), photo=images[0].media), loop
-                    )
-                    result = fut.result()
-                    if result.photo:
-                        file = asyncio.run_coroutine_threadsafe(
-                            bot.get_file(result.photo[-1].file_id), loop
-                        ).result()
-                        if file.file_path.startswith('http'):
-                            file_url = file.file_path
-                        else:
-                            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                        print(f"Debug - file.file_path: {file.file_path}")
-                        print(f"Debug - constructed URL: {file_url}")
-                        save_message(user_id, 'admin', f'[image]{file_url}')
-                sent = True
-                file_handled = True
-            if videos:
-                if len(videos) > 1:
-                    print('Sending media group (videos)...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_media_group(chat_id=int(user_id), media=videos), loop
-                    )
-                    result = fut.result()
-                    for i, msg in enumerate(result):
-                        if msg.video:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(msg.video.file_id), loop
-                            ).result()
-                            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                            save_message(user_id, 'admin', f'[video]{file_url}')
-                else:
-                    print('Sending single video...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_video(chat_id=int(user_id), video=videos[0].media), loop
-                    )
-                    result = fut.result()
-                    if result.video:
-                        file = asyncio.run_coroutine_threadsafe(
-                            bot.get_file(result.video.file_id), loop
-                        ).result()
-                        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                        save_message(user_id, 'admin', f'[video]{file_url}')
-                sent = True
-                file_handled = True
-            if audios:
-                if len(audios) > 1:
-                    print('Sending media group (audios)...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_media_group(chat_id=int(user_id), media=audios), loop
-                    )
-                    result = fut.result()
-                    for i, msg in enumerate(result):
-                        if msg.audio:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(msg.audio.file_id), loop
-                            ).result()
-                            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                            save_message(user_id, 'admin', f'[audio]{file_url}')
-                else:
-                    print('Sending single audio...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_audio(chat_id=int(user_id), audio=audios[0].media), loop
-                    )
-                    result = fut.result()
-                    if result.audio:
-                        file = asyncio.run_coroutine_threadsafe(
-                            bot.get_file(result.audio.file_id), loop
-                        ).result()
-                        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                        save_message(user_id, 'admin', f'[audio]{file_url}')
-                sent = True
-                file_handled = True
+            tmp_dir, by_kind = spool_uploads(files)
+        except UploadError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        if not by_kind:
+            cleanup(tmp_dir)
+            return jsonify({'status': 'error', 'message': 'No supported media files sent'}), 400
+        # ?async=1: return right away, completion is reported over Socket.IO ('media_sent')
+        if request.args.get('async') or request.form.get('async'):
+            job_id = uuid.uuid4().hex
+            media_jobs[job_id] = {'job_id': job_id, 'user_id': user_id, 'status': 'sending', 'files': len(files)}
+            try:
+                submit(media_job(job_id, user_id, tmp_dir, by_kind))
+            except RuntimeError as e:
+                media_jobs.pop(job_id, None)
+                cleanup(tmp_dir)
+                return jsonify({'status': 'error', 'message': str(e)}), 503
+            return jsonify({'status': 'accepted', 'job_id': job_id}), 202
+
+        try:
+            future = submit(send_media(bot, int(user_id), by_kind))
+        except RuntimeError as e:
+            cleanup(tmp_dir)
+            return jsonify({'status': 'error', 'message': str(e)}), 503
+
+        try:
+            sent_media = future.result(timeout=MEDIA_SEND_TIMEOUT)
         except Exception as e:
             print(f"Telegram file send error: {e}")
             traceback.print_exc()
             response = {'status': 'error', 'message': f'Failed to send media: {str(e)}'}
             return jsonify(response), 500
         finally:
-            for temp_path in temp_paths:
-                try:
-                    os.remove(temp_path)
-                except Exception as e:
-                    print('Error removing temp file:', temp_path, e)
+            cleanup(tmp_dir)
+        for attachment in sent_media:
+            message_writer.save(user_id, 'admin', '', kind=attachment['kind'], attachments=[attachment])
         response = {'status': 'success', 'message': 'Media sent successfully'}
-        socketio.emit('new_message', {'user_id': user_id}, room='chat_' + str(user_id))
         return jsonify(response), 200
 
     # If neither message nor files were handled
-    if not message_handled and not file_handled:
+    if not message_handled:
         response = {'status': 'error', 'message': 'No message or files sent'}
         return jsonify(response), 400
 
     # If only message was handled
-    socketio.emit('new_message', {'user_id': user_id}, room='chat_' + str(user_id))
     return jsonify(response), 200
 
+def idempotency_key(req):
+    return req.headers.get('Idempotency-Key') or req.form.get('idempotency_key') or None
+
+@app.route('/outbox/<int:outbox_id>')
+def outbox_status(outbox_id):
+    queued = outbox.get(outbox_id)
+    if queued is None:
+        return jsonify({'status': 'error', 'message': 'Message not found'}), 404
+    return jsonify(queued)
+
 @app.route('/send_one', methods=['POST'])
 def send_one():
     user_id = request.form.get('user_id')
     message = request.form.get('message')
     if not user_id or not message:
         return {'status': 'error', 'msg': 'Missing user_id or message'}, 400
-    save_message(int(user_id), 'admin', message)
-    try:
-        asyncio.run_coroutine_threadsafe(
-            bot.send_message(chat_id=int(user_id), text=message), loop
-        )
-    except Exception as e:
-        print(f"Telegram send error: {e}")
-    socketio.emit('new_message', {'user_id': int(user_id)}, room='chat_' + str(user_id))
-    return {'status': 'ok'}
+    # Stored first, delivered by the outbox workers; a repeated idempotency key returns the original
+    queued, created = outbox.enqueue(int(user_id), message, idempotency_key(request))
+    if created:
+        emit_queued(queued, message)
+    return {'status': 'ok', 'outbox_id': queued['outbox_id'], 'delivery_status': queued['status'], 'duplicate': not created}
 
 @app.route('/send_all', methods=['POST'])
 def send_all():
     message = request.form.get('message')
     if not message:
         return {'status': 'error', 'msg': 'Missing message'}, 400
-    users = get_all_users()
-    for u in users:
-        save_message(u[0], 'admin', message)
-        try:
-            asyncio.run_coroutine_threadsafe(
-                bot.send_message(chat_id=int(u[0]), text=message), loop
-            )
-        except Exception as e:
-            print(f"Telegram send error: {e}")
-        socketio.emit('new_message', {'user_id': u[0]}, room='chat_' + str(u[0]))
-    return {'status': 'ok', 'count': len(users)}
+    # Optional label=<name>: only users carrying that label
+    label = request.form.get('label') or None
+    if label is not None and label not in get_label_counts([label]):
+        return {'status': 'error', 'msg': f'Unknown label {label}'}, 404
+    # Delivery happens in the background broadcast engine; poll /broadcasts/<job_id> for progress
+    job_id = broadcaster.create_job(message, label=label)
+    job = broadcaster.progress(job_id)
+    return {'status': 'ok', 'job_id': job_id, 'count': job['total']}, 202
+
+MAX_BROADCASTS_LISTED = 200
+
+@app.route('/broadcasts')
+def list_broadcasts():
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_BROADCASTS_LISTED:
+        return jsonify({'status': 'error', 'message': f'limit must be 1-{MAX_BROADCASTS_LISTED}'}), 400
+    return jsonify(broadcaster.list_jobs(limit))
+
+@app.route('/broadcasts/<int:job_id>')
+def broadcast_progress(job_id):
+    job = broadcaster.progress(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Broadcast not found'}), 404
+    return jsonify(job)
+
+@app.route('/broadcasts/<int:job_id>/<action>', methods=['POST'])
+def broadcast_control(job_id, action):
+    handlers = {'pause': broadcaster.pause, 'resume': broadcaster.resume, 'cancel': broadcaster.cancel}
+    if action not in handlers:
+        return jsonify({'status': 'error', 'message': f'Unknown action {action}'}), 400
+    if broadcaster.progress(job_id) is None:
+        return jsonify({'status': 'error', 'message': 'Broadcast not found'}), 404
+    if not handlers[action](job_id):
+        return jsonify({'status': 'error', 'message': f'Cannot {action} broadcast in its current state'}), 409
+    return jsonify(broadcaster.progress(job_id))
+
+@app.route('/metrics/writer')
+def writer_metrics():
+    return jsonify(message_writer.metrics())
 
 @app.route('/user/<int:user_id>/label', methods=['POST'])
 def set_user_label(user_id):
-    label = request.json.get('label')
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('UPDATE users SET label = ? WHERE user_id = ?', (label, user_id))
-    conn.commit()
-    conn.close()
-    return jsonify({'status': 'ok', 'user_id': user_id, 'label': label})
+    # Replaces the user's labels with this one; /labels/bulk adds and removes without replacing
+    label = (request.json.get('label') or '').strip()
+    db_set_user_label(user_id, label)
+    return jsonify({'status': 'ok', 'user_id': user_id, 'label': label or None})
+
+MAX_LABEL_LENGTH = 64
+
+@app.route('/labels')
+def list_labels():
+    # {name: users carrying it}, from counts kept by triggers
+    return jsonify(get_label_counts())
+
+@app.route('/labels/bulk', methods=['POST'])
+def bulk_labels():
+    # {"add": [...], "remove": [...]} for {"user_ids": [...]} or {"filter": {...}} with the
+    # /dashboard-users filter parameters, or {"all": true}; each list is applied in one transaction
+    data = request.get_json(silent=True) or {}
+    add = [str(n).strip() for n in data.get('add') or []]
+    remove = [str(n).strip() for n in data.get('remove') or []]
+    if not add and not remove:
+        return jsonify({'status': 'error', 'message': 'Nothing to add or remove'}), 400
+    if any(not n or len(n) > MAX_LABEL_LENGTH for n in add + remove):
+        return jsonify({'status': 'error', 'message': f'Labels must be 1-{MAX_LABEL_LENGTH} characters'}), 400
+    user_ids, filters = None, None
+    try:
+        if data.get('user_ids') is not None:
+            user_ids = [int(u) for u in data['user_ids']]
+        elif data.get('filter') is not None or data.get('all') is True:
+            spec = data.get('filter') or {}
+            # A typo must not widen the filter to every user
+            if not isinstance(spec, dict) or set(spec) - set(USER_FILTER_KEYS) or not all(isinstance(v, str) for v in spec.values()):
+                return jsonify({'status': 'error', 'message': f"filter takes string values for {', '.join(USER_FILTER_KEYS)}"}), 400
+            filters = user_filters(spec)
+            if data.get('all') is not True and all(v is None for v in filters.values()):
+                return jsonify({'status': 'error', 'message': 'Filter matches every user; pass "all": true to label everyone'}), 400
+        else:
+            return jsonify({'status': 'error', 'message': 'Pass user_ids, a filter or "all": true'}), 400
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Invalid user_ids or filter'}), 400
+    added = label_users(add, user_ids=user_ids, filters=filters) if add else 0
+    removed = label_users(remove, user_ids=user_ids, filters=filters, remove=True) if remove else 0
+    return jsonify({'status': 'ok', 'added': added, 'removed': removed, 'labels': get_label_counts(add + remove)})
+
+@app.route('/import/users', methods=['POST'])
+def import_users_route():
+    # CSV or NDJSON as the request body or a 'file' upload (Content-Encoding: gzip or a .gz name);
+    # ?format=csv|ndjson&label=...; ?resume=<job_id> with the same source continues an interrupted
+    # job after the rows it already committed. Progress goes to the inbox room as 'import_progress'
+    if 'file' in request.files:
+        upload = request.files['file']
+        stream, compressed = upload.stream, (upload.filename or '').endswith('.gz')
+    else:
+        stream, compressed = request.stream, request.headers.get('Content-Encoding') == 'gzip'
+    if request.args.get('resume'):
+        try:
+            job = importer.get_job(int(request.args['resume']))
+        except ValueError:
+            job = None
+        if job is None:
+            return jsonify({'status': 'error', 'message': 'Import job not found'}), 404
+        if job['status'] == 'completed':
+            return jsonify({'status': 'error', 'message': 'Import job already completed', 'job': job}), 409
+        job_id = job['job_id']
+    else:
+        fmt = request.args.get('format', 'csv')
+        if fmt not in importer.FORMATS:
+            return jsonify({'status': 'error', 'message': f"format must be one of {', '.join(importer.FORMATS)}"}), 400
+        labels = [n.strip() for n in request.args.getlist('label') if n.strip()]
+        if any(len(n) > MAX_LABEL_LENGTH for n in labels):
+            return jsonify({'status': 'error', 'message': f'Labels must be 1-{MAX_LABEL_LENGTH} characters'}), 400
+        source = request.files['file'].filename if 'file' in request.files else 'upload'
+        job_id = importer.create_job(source, fmt, labels)
+    try:
+        job = importer.run_import(job_id, stream, compressed,
+                                  on_progress=lambda j: events.emit('import_progress', j, INBOX_ROOM))
+    except Exception as e:
+        print(f"Import {job_id} interrupted: {e}")
+        return jsonify({'status': 'error', 'message': f'Import interrupted: {e}', 'job': importer.get_job(job_id)}), 500
+    return jsonify({'status': 'ok', 'job': job})
+
+@app.route('/import/<int:job_id>')
+def import_status(job_id):
+    job = importer.get_job(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Import job not found'}), 404
+    return jsonify(job)
+
+@socketio.on('connect')
+def on_connect():
+    # Where the event stream is now; pass it back in 'join' after a reconnect
+    emit('hello', {'epoch': events.epoch, 'event_id': events.last_id})
 
 @socketio.on('join')
 def on_join(data):
-    room = data.get('room')
-    join_room(room)
+    # {'room': 'chat_<id>' | 'inbox'} or {'rooms': [...]}; after a reconnect add 'last_event_id' and
+    # 'epoch' to get the events missed meanwhile (drop any event_id already seen), or 'resync' if
+    # they are no longer buffered and the client has to reload over REST
+    joined = data.get('rooms') or [data.get('room')]
+    for room in joined:
+        join_room(room)
+    if data.get('last_event_id') is None:
+        return
+    try:
+        last_id = int(data['last_event_id'])
+    except (TypeError, ValueError):
+        last_id = -1
+    missed = events.replay(last_id, data.get('epoch'), joined) if last_id >= 0 else None
+    if missed is None:
+        emit('resync', {'epoch': events.epoch, 'event_id': events.last_id})
+        return
+    for event, payload in missed:
+        emit(event, payload)
 
-if __name__ == '__main__':
-    import os
-    port = int(os.environ.get("PORT", 5001))
+@app.route('/metrics/events')
+def events_metrics():
+    return jsonify(events.metrics())
+
+async def convert_legacy_messages():
+    # Rewrites pre-m008 "[image]url" rows a chunk at a time, letting other writers in between chunks
+    converted = 0
+    while True:
+        count = await run_blocking(db_convert_legacy_messages)
+        if not count:
+            break
+        converted += count
+        await asyncio.sleep(0.05)
+    if converted:
+        print(f"Converted {converted} legacy messages to typed storage")
+
+async def backfill_search():
+    # Indexes messages saved before m010 for /search, a chunk at a time
+    indexed = 0
+    while True:
+        count = await run_blocking(db_backfill_search)
+        if not count:
+            break
+        indexed += count
+        await asyncio.sleep(0.05)
+    if indexed:
+        print(f"Search index backfilled with {indexed} messages")
+
+async def serve(port, host='127.0.0.1'):
+    """Run everything on the runtime loop until SIGINT/SIGTERM, then shut down in reverse order."""
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
 
-    # Flask-SocketIO আলাদা থ্রেডে
-    flask_thread = Thread(target=lambda: socketio.run(app, port=port, debug=False, allow_unsafe_werkzeug=True), daemon=True)
-    flask_thread.start()
+    async with contextlib.AsyncExitStack() as stack:
+        # Last registered, first closed: the writer and presence flush after everything else stopped
+        presence.start()
+        stack.callback(presence.persist)
+        message_writer.start()
+        stack.callback(message_writer.stop)
 
-    # Pyrogram bot main thread-এ (join approval এর জন্য)
-    print("Pyrogram bot running and waiting for join requests...")
-    import asyncio
-    asyncio.set_event_loop(asyncio.new_event_loop())
-    pyro_app.run() 
+        await application.initialize()
+        stack.push_async_callback(application.shutdown)
+        await application.start()
+        stack.push_async_callback(application.stop)
+        update_dispatcher.start()
+        stack.push_async_callback(update_dispatcher.stop)
+        if WEBHOOK_URL:
+            if not WEBHOOK_SECRET:
+                raise RuntimeError('WEBHOOK_SECRET must be set when WEBHOOK_URL is')
+            await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=Update.ALL_TYPES)
+        else:
+            # start_polling() removes a previously set webhook; chat_member updates are only sent when asked for
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            stack.push_async_callback(application.updater.stop)
+
+        join_pipeline.start()
+        stack.push_async_callback(join_pipeline.stop)
+        await pyro_app.start()
+        stack.push_async_callback(pyro_app.stop)
+
+        tasks = [asyncio.create_task(coro) for coro in (broadcaster.run(), outbox.run(), invite_pool.run(),
+                                                          media_groups.run(), convert_legacy_messages(), backfill_search())]
+
+        async def cancel_tasks():
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        stack.push_async_callback(cancel_tasks)
+
+        # Flask-SocketIO (threading mode) serves on its own threads and reaches the loop via runtime.submit()
+        server = make_server(host, port, app, threaded=True)
+        Thread(target=server.serve_forever, name='web', daemon=True).start()
+        stack.callback(server.shutdown)
+
+        print(f"Dashboard API on http://{host}:{port}, Telegram bot and Pyrogram running")
+        await stop.wait()
+        print("Shutting down...")
+
+def main():
+    port = int(os.environ.get("PORT", 5001))
+    runtime.run(serve(port))
+
+if __name__ == '__main__':
+    main()
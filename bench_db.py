@@ -0,0 +1,64 @@
+"""Microbenchmark: connect-per-call helpers (old api.py/db.py) vs the pooled WAL layer in db.py.
+
+    python bench_db.py [rows]
+"""
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import db
+
+
+def legacy_save_message(db_name, user_id, sender, message):
+    conn = sqlite3.connect(db_name)
+    c = conn.cursor()
+    c.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)',
+              (user_id, sender, message, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    conn.commit()
+    conn.close()
+
+
+def legacy_get_chat_history(db_name, user_id, limit=100):
+    conn = sqlite3.connect(db_name)
+    c = conn.cursor()
+    c.execute('SELECT id, sender, message, timestamp FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?', (user_id, limit))
+    messages = c.fetchall()
+    conn.close()
+    return messages
+
+
+def timed(label, n, fn):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {n / elapsed:>10.0f} ops/s")
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = os.path.join(tmp, 'legacy.db')
+        db.DB_NAME = legacy_db
+        db.init_db()
+        db.close_pool()
+        # init_db switched the file to WAL; put the legacy file back to the default journal
+        conn = sqlite3.connect(legacy_db)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.close()
+
+        db.DB_NAME = os.path.join(tmp, 'pooled.db')
+        db.init_db()
+
+        timed('legacy inserts', rows, lambda i: legacy_save_message(legacy_db, i % 100, 'user', 'hello'))
+        timed('pooled inserts', rows, lambda i: db.save_message(i % 100, 'user', 'hello'))
+        timed('legacy reads', rows, lambda i: legacy_get_chat_history(legacy_db, i % 100))
+        timed('pooled reads', rows, lambda i: db.get_chat_history(i % 100))
+        db.close_pool()
+
+
+if __name__ == '__main__':
+    main()
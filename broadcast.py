@@ -0,0 +1,275 @@
+import asyncio
+import threading
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from db import connection, now_str, to_ts, transaction
+from ratelimit import PerChatLimiter, TokenBucket
+from runtime import run_blocking
+
+# Telegram allows ~30 messages/s across all chats and ~1 message/s per chat.
+GLOBAL_RATE = 28
+PER_CHAT_INTERVAL = 1.0
+WORKERS = 8
+CHUNK_SIZE = 200
+FLUSH_EVERY = 100
+MAX_ATTEMPTS = 5
+PROGRESS_INTERVAL = 1.0  # at most one progress event per job this often, plus the final one
+
+# Job states: queued -> running -> completed, with paused / cancelled set by the admin.
+
+
+class BroadcastEngine:
+    """Persistent, rate-limited broadcast jobs.
+
+    Jobs and per-recipient delivery state live in SQLite, so a restart picks up
+    every queued/running job where it left off.
+    """
+
+    def __init__(self, bot, rate=GLOBAL_RATE, workers=WORKERS, on_progress=None, bucket=None):
+        self.bot = bot
+        self.workers = workers
+        self.on_progress = on_progress
+        # Pass a shared bucket so broadcasts and other senders stay under one global limit
+        self.bucket = bucket or TokenBucket(rate)
+        self.per_chat = PerChatLimiter(PER_CHAT_INTERVAL)
+        self.loop = None
+        self._wakeup = None
+        self._control = {}  # job_id -> 'paused' / 'cancelled' while that job is running
+        self._last_progress = {}  # job_id -> monotonic time of the last progress event
+
+    # --- Admin side (called from Flask threads) ---
+
+    def create_job(self, message, user_ids=None, label=None):
+        """Queue a broadcast to `user_ids`, or the users carrying `label` (default: every user), and return the job id."""
+        now = now_str()
+        with transaction() as conn:
+            c = conn.cursor()
+            c.execute('INSERT INTO broadcast_jobs (message, status, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                      (message, 'queued', now, now))
+            job_id = c.lastrowid
+            if label is not None:
+                c.execute("INSERT OR IGNORE INTO broadcast_recipients (job_id, user_id, status) "
+                          "SELECT ?, user_id, 'pending' FROM user_labels WHERE label_id = (SELECT id FROM labels WHERE name = ?)",
+                          (job_id, label))
+            elif user_ids is None:
+                c.execute("INSERT OR IGNORE INTO broadcast_recipients (job_id, user_id, status) "
+                          "SELECT ?, user_id, 'pending' FROM users", (job_id,))
+            else:
+                c.executemany("INSERT OR IGNORE INTO broadcast_recipients (job_id, user_id, status) VALUES (?, ?, 'pending')",
+                              [(job_id, int(u)) for u in user_ids])
+            c.execute('SELECT COUNT(*) FROM broadcast_recipients WHERE job_id = ?', (job_id,))
+            total = c.fetchone()[0]
+            c.execute('UPDATE broadcast_jobs SET total = ? WHERE id = ?', (total, job_id))
+        self._wake()
+        return job_id
+
+    def pause(self, job_id):
+        return self._set_status(job_id, 'paused', ('queued', 'running'))
+
+    def resume(self, job_id):
+        return self._set_status(job_id, 'queued', ('paused',))
+
+    def cancel(self, job_id):
+        return self._set_status(job_id, 'cancelled', ('queued', 'running', 'paused'))
+
+    def _set_status(self, job_id, status, allowed_from):
+        placeholders = ','.join('?' * len(allowed_from))
+        with connection() as conn:
+            changed = conn.execute(f'UPDATE broadcast_jobs SET status = ?, updated_at = ? WHERE id = ? AND status IN ({placeholders})',
+                                   (status, now_str(), job_id, *allowed_from)).rowcount > 0
+        if changed:
+            if status in ('paused', 'cancelled'):
+                self._control[job_id] = status
+            else:
+                self._control.pop(job_id, None)
+            self._wake()
+        return changed
+
+    def progress(self, job_id):
+        with connection() as conn:
+            row = conn.execute('SELECT id, message, status, total, sent, failed, created_at, updated_at FROM broadcast_jobs WHERE id = ?',
+                               (job_id,)).fetchone()
+        return self._job_dict(row) if row else None
+
+    def list_jobs(self, limit=20):
+        with connection() as conn:
+            rows = conn.execute('SELECT id, message, status, total, sent, failed, created_at, updated_at FROM broadcast_jobs '
+                                'ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        return [self._job_dict(r) for r in rows]
+
+    @staticmethod
+    def _job_dict(row):
+        job_id, message, status, total, sent, failed, created_at, updated_at = row
+        return {
+            'job_id': job_id,
+            'message': message,
+            'status': status,
+            'total': total,
+            'sent': sent,
+            'failed': failed,
+            'pending': max(total - sent - failed, 0),
+            'created_at': created_at,
+            'updated_at': updated_at
+        }
+
+    # --- Scheduler side (runs on the runtime event loop) ---
+
+    def start(self):
+        """Run the scheduler on its own thread and loop; api.py instead runs run() on the runtime loop."""
+        thread = threading.Thread(target=lambda: asyncio.run(self.run()), name='broadcast', daemon=True)
+        thread.start()
+        return thread
+
+    def _wake(self):
+        if self.loop is not None and self._wakeup is not None:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        while True:
+            job = await run_blocking(self._next_job)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run_job(*job)
+            except Exception as e:
+                print(f"Broadcast job {job[0]} crashed: {e}")
+                await asyncio.sleep(5)
+
+    def _next_job(self):
+        # Jobs left 'running' by a previous process are resumed, not restarted
+        with connection() as conn:
+            return conn.execute("SELECT id, message FROM broadcast_jobs WHERE status IN ('queued', 'running') ORDER BY id LIMIT 1").fetchone()
+
+    async def _run_job(self, job_id, message):
+        self._control.pop(job_id, None)
+        # A pause/cancel that landed after _next_job picked the job: its status says so, leave it
+        if not await run_blocking(self._mark_running, job_id):
+            return
+        print(f"Broadcast job {job_id} running")
+        last_user_id = -1 << 63
+        while job_id not in self._control:
+            chunk = await run_blocking(self._pending_chunk, job_id, last_user_id)
+            if not chunk:
+                break
+            last_user_id = chunk[-1]
+            await self._deliver_chunk(job_id, message, chunk)
+        state = self._control.pop(job_id, None)
+        if state is None:
+            if await run_blocking(self._mark_completed, job_id):
+                print(f"Broadcast job {job_id} completed")
+        else:
+            print(f"Broadcast job {job_id} {state}")
+        await self._emit_progress(job_id, final=True)
+
+    @staticmethod
+    def _mark_running(job_id):
+        # Jobs already 'running' are being resumed after a restart
+        with connection() as conn:
+            return conn.execute("UPDATE broadcast_jobs SET status = 'running', updated_at = ? "
+                                "WHERE id = ? AND status IN ('queued', 'running')", (now_str(), job_id)).rowcount > 0
+
+    @staticmethod
+    def _pending_chunk(job_id, last_user_id):
+        with connection() as conn:
+            return [r[0] for r in conn.execute(
+                "SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND user_id > ? AND status = 'pending' "
+                "ORDER BY user_id LIMIT ?", (job_id, last_user_id, CHUNK_SIZE))]
+
+    @staticmethod
+    def _mark_completed(job_id):
+        with connection() as conn:
+            return conn.execute("UPDATE broadcast_jobs SET status = 'completed', updated_at = ? "
+                                "WHERE id = ? AND status = 'running'", (now_str(), job_id)).rowcount > 0
+
+    async def _deliver_chunk(self, job_id, message, chunk):
+        queue = asyncio.Queue()
+        for user_id in chunk:
+            queue.put_nowait(user_id)
+        results = []
+
+        async def worker():
+            while job_id not in self._control:
+                try:
+                    user_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                results.append(await self._deliver_one(user_id, message))
+                if len(results) >= FLUSH_EVERY:
+                    batch = results[:]
+                    results.clear()
+                    await self._flush(job_id, message, batch)
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        await self._flush(job_id, message, results)
+
+    async def _deliver_one(self, user_id, message):
+        error = None
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await self.bucket.acquire()
+            await self.per_chat.acquire(user_id)
+            try:
+                sent = await self.bot.send_message(chat_id=user_id, text=message)
+                return ('sent', attempt, None, sent.message_id, user_id)
+            except RetryAfter as e:
+                retry_after = float(e.retry_after)
+                print(f"Broadcast flood limit hit, pausing {retry_after}s")
+                self.bucket.block(retry_after)
+                self.per_chat.block(user_id, retry_after)
+                error = str(e)
+            except (Forbidden, BadRequest) as e:
+                # Blocked the bot / deleted account / bad chat: retrying will not help
+                return ('failed', attempt, str(e), None, user_id)
+            except NetworkError as e:
+                error = str(e)
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except Exception as e:
+                return ('failed', attempt, str(e), None, user_id)
+        return ('failed', MAX_ATTEMPTS, error, None, user_id)
+
+    async def _flush(self, job_id, message, results):
+        if not results:
+            return
+        await run_blocking(self._record, job_id, message, results)
+        await self._emit_progress(job_id)
+
+    @staticmethod
+    def _record(job_id, message, results):
+        now = now_str()
+        sent = sum(1 for r in results if r[0] == 'sent')
+        with transaction() as conn:
+            # Chat history only for recipients actually attempted, with the outcome; cancelled or
+            # still pending ones show nothing
+            conn.executemany("INSERT INTO messages (user_id, sender, message, timestamp, ts, kind, delivery_status, "
+                             "telegram_message_id) VALUES (?, 'admin', ?, ?, ?, 'text', ?, ?)",
+                             [(user_id, message, now, to_ts(now), status, msg_id) for status, _, _, msg_id, user_id in results])
+            conn.executemany('UPDATE broadcast_recipients SET status = ?, attempts = ?, error = ?, telegram_message_id = ?, '
+                             'updated_at = ? WHERE job_id = ? AND user_id = ?',
+                             [(status, attempts, error, msg_id, now, job_id, user_id)
+                              for status, attempts, error, msg_id, user_id in results])
+            conn.execute('UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ?, updated_at = ? WHERE id = ?',
+                         (sent, len(results) - sent, now, job_id))
+
+    async def _emit_progress(self, job_id, final=False):
+        if self.on_progress is None:
+            return
+        # One coalesced summary per interval, however many recipients were flushed in between
+        now = time.monotonic()
+        if final:
+            self._last_progress.pop(job_id, None)
+        elif now - self._last_progress.get(job_id, 0) < PROGRESS_INTERVAL:
+            return
+        else:
+            self._last_progress[job_id] = now
+        try:
+            self.on_progress(await run_blocking(self.progress, job_id))
+        except Exception as e:
+            print(f"Broadcast progress callback failed: {e}")
@@ -16,4 +16,17 @@ CHANNEL_URL = 'https://t.me/+mEcMgPqw3xphODM1'  # Replace with your actual chann
 API_ID = 29584645
 API_HASH = "7ca25762b3e7e6b3110701394d5a291b"
 CHAT_ID = -1002286109418  # Channel/Group ID (negative sign সহ)
-WELCOME_TEXT = "👋 Welcome to our Telegram group!\n\nWe're excited to have you join our community. Here you can connect, share, and learn with others.\n\nPlease be respectful and follow the group guidelines. If you have any questions, feel free to ask.\n\nEnjoy your stay!"
\ No newline at end of file
+# Join requests through these invite links are approved in bulk (approve_all_chat_join_requests)
+BULK_APPROVE_LINKS = []
+WELCOME_TEXT = "👋 Welcome to our Telegram group!\n\nWe're excited to have you join our community. Here you can connect, share, and learn with others.\n\nPlease be respectful and follow the group guidelines. If you have any questions, feel free to ask.\n\nEnjoy your stay!"
+
+# Webhook mode: set WEBHOOK_URL to this server's public https base URL (e.g. https://bot.example.com)
+# to receive bot updates at /telegram/webhook instead of polling. WEBHOOK_SECRET is then required
+# (1-256 chars: A-Z, a-z, 0-9, _ and -); Telegram sends it back with every update.
+WEBHOOK_URL = ''
+WEBHOOK_SECRET = ''
+UPDATE_WORKERS = 8  # updates for different users are handled in parallel, one user's stay in order
+UPDATE_QUEUE_SIZE = 1000
+
+# Set True when a front server (nginx X-Accel / Apache X-Sendfile) serves /media files from disk
+MEDIA_X_SENDFILE = False
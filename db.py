@@ -1,67 +1,757 @@
 import sqlite3
 import datetime
+import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from itertools import groupby
+
+import migrations
 
 DB_NAME = 'users.db'
 
+# Connections are pooled and reused instead of opened per query. Every pooled
+# connection runs in WAL mode so dashboard reads never wait on bot writes.
+POOL_SIZE = 8
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',  # fsync on checkpoint, not on every commit
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',  # 16MB page cache per connection
+    'PRAGMA mmap_size=134217728',
+)
+
+_pool = queue.LifoQueue()
+_local = threading.local()
+
+
+def _connect():
+    conn = sqlite3.connect(DB_NAME, timeout=10, isolation_level=None,
+                           check_same_thread=False, cached_statements=256)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection. Nested calls on the same thread share it."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    _local.conn = conn
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        if _pool.qsize() < POOL_SIZE:
+            _pool.put(conn)
+        else:
+            conn.close()
+
+
+@contextmanager
+def transaction():
+    """Run the block in one write transaction (joins an outer one if already open)."""
+    with connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+def close_pool():
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+def now_str():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def to_ts(text):
+    """'YYYY-MM-DD HH:MM:SS' local time -> epoch seconds (what the integer columns store)."""
+    return int(datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S').timestamp())
+
+
+def from_ts(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') if ts is not None else None
+
+
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        full_name TEXT,
-        username TEXT,
-        join_date TEXT,
-        invite_link TEXT,
-        photo_url TEXT,
-        label TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        sender TEXT,
-        message TEXT,
-        timestamp TEXT
-    )''')
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        migrations.migrate(conn)
+
+
+# --- Users ---
+
+_UPSERT_USER = '''INSERT INTO users (user_id, full_name, username, join_date, join_ts, invite_link, photo_url)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        full_name = excluded.full_name,
+        username = excluded.username,
+        invite_link = COALESCE(excluded.invite_link, users.invite_link),
+        photo_url = COALESCE(excluded.photo_url, users.photo_url)'''
+
 
 def add_user(user_id, full_name, username, join_date, invite_link=None, photo_url=None):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, invite_link, photo_url) VALUES (?, ?, ?, ?, ?, ?)', (user_id, full_name, username, join_date, invite_link, photo_url))
-    c.execute('UPDATE users SET invite_link = ?, photo_url = ? WHERE user_id = ?', (invite_link, photo_url, user_id))
-    conn.commit()
-    conn.close()
+    # Keeps the original join_date; only overwrites link/photo when a new value is given
+    with connection() as conn:
+        conn.execute(_UPSERT_USER, (user_id, full_name, username, join_date, to_ts(join_date), invite_link, photo_url))
+
+
+def add_users(rows):
+    """Upsert many (user_id, full_name, username, join_date, invite_link) rows in one transaction."""
+    with transaction() as conn:
+        conn.executemany(_UPSERT_USER, [(user_id, full_name, username, join_date, to_ts(join_date), invite_link, None)
+                                        for user_id, full_name, username, join_date, invite_link in rows])
+
 
 def get_total_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    total = c.fetchone()[0]
-    conn.close()
-    return total
-
-def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url FROM users')
-    users = c.fetchall()
-    conn.close()
-    return users
-
-def save_message(user_id, sender, message, timestamp=None):
+    return _get_counter('users')
+
+
+def get_user(user_id):
+    with connection() as conn:
+        return conn.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_unique_id FROM users WHERE user_id = ?',
+                            (user_id,)).fetchone()
+
+
+def _online_since(minutes):
+    return int(time.time()) - minutes * 60
+
+
+def _labels_of(user_id_column):
+    # JSON array of the user's label names, as a column expression
+    return ('(SELECT json_group_array(l.name) FROM user_labels ul JOIN labels l ON l.id = ul.label_id '
+            f'WHERE ul.user_id = {user_id_column})')
+
+# Sort orders for get_users_page: expression each is indexed on (user_id breaks ties)
+USER_SORTS = {
+    'join_date': 'join_ts',
+    'name': 'full_name COLLATE NOCASE',
+    'username': 'username COLLATE NOCASE',
+    'last_activity': 'COALESCE(last_activity, 0)',
+}
+
+
+# A label filter as a per-row probe of the user_labels primary key, so the page can walk its sort index
+_HAS_LABEL = ('EXISTS (SELECT 1 FROM user_labels ul WHERE ul.user_id = users.user_id '
+              'AND ul.label_id = (SELECT id FROM labels WHERE name = ?))')
+# Below this many users a label's page is collected from user_labels and sorted, rather than found
+# by walking the whole sort index
+SMALL_LABEL = 5000
+
+
+def _like_prefix(prefix):
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _user_filters(filters, join_ts='users.join_ts'):
+    """WHERE clauses and params for a filter dict.
+
+    Keys: label, prefix (of full name or username, case-insensitive),
+    joined_from / joined_to (epoch seconds, to exclusive), invite_link.
+    """
+    clauses, params = [], []
+    filters = filters or {}
+    if filters.get('label') is not None:
+        clauses.append(_HAS_LABEL)
+        params.append(filters['label'])
+    if filters.get('prefix'):
+        clauses.append("(users.full_name LIKE ? ESCAPE '\\' OR users.username LIKE ? ESCAPE '\\')")
+        params += [_like_prefix(filters['prefix'])] * 2
+    if filters.get('joined_from') is not None:
+        clauses.append(f'{join_ts} >= ?')
+        params.append(filters['joined_from'])
+    if filters.get('joined_to') is not None:
+        clauses.append(f'{join_ts} < ?')
+        params.append(filters['joined_to'])
+    if filters.get('invite_link') is not None:
+        clauses.append('users.invite_link = ?')
+        params.append(filters['invite_link'])
+    return clauses, params
+
+
+def count_users(filters=None):
+    """Number of users matching `filters`; a trigger-kept counter when there are none or only a label."""
+    clauses, params = _user_filters(filters)
+    if not clauses:
+        return get_total_users()
+    if [k for k, v in filters.items() if v is not None] == ['label']:
+        return get_label_counts([filters['label']]).get(filters['label'], 0)
+    with connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM users WHERE ' + ' AND '.join(clauses), params).fetchone()[0]
+
+
+def _users_page_query(page_size, offset=0, after=None, online_minutes=5, filters=None, sort='join_date',
+                      descending=True, label_users=None):
+    """(sql, params) for get_users_page; `label_users` is how many users carry filters['label']."""
+    filters = dict(filters or {})
+    label = filters.get('label')
+    key, tie, source = USER_SORTS[sort], 'users.user_id', 'users'
+    if label is not None and not filters.get('prefix'):
+        filters.pop('label')
+        if sort == 'join_date':
+            # Walk idx_user_labels_join: the label's users already in join order
+            key, tie = 'ul.join_ts', 'ul.user_id'
+            source = 'user_labels ul JOIN users ON users.user_id = ul.user_id AND ul.label_id = (SELECT id FROM labels WHERE name = ?)'
+        elif label_users is not None and label_users < SMALL_LABEL:
+            filters['label_ids'] = label
+        else:
+            filters['label'] = label
+    clauses, params = _user_filters(filters, join_ts=key if key == 'ul.join_ts' else 'users.join_ts')
+    if 'label_ids' in filters:
+        clauses.append('users.user_id IN (SELECT user_id FROM user_labels WHERE label_id = (SELECT id FROM labels WHERE name = ?))')
+        params.append(filters['label_ids'])
+    if source != 'users':
+        params.insert(0, label)
+    if after is not None:
+        # key >= k AND (key > k OR user_id > id): same as the row value comparison, but seeks on the index
+        cmp = '<' if descending else '>'
+        clauses.append(f'{key} {cmp}= ? AND ({key} {cmp} ? OR {tie} {cmp} ?)')
+        params += [after[0], after[0], after[1]]
+        offset = 0
+    direction = 'DESC' if descending else 'ASC'
+    sql = (f'SELECT users.user_id, full_name, username, join_date, invite_link, photo_unique_id, {_labels_of("users.user_id")}, '
+           f'COALESCE(last_activity >= ?, 0), users.join_ts, {key} FROM {source} ')
+    if clauses:
+        sql += 'WHERE ' + ' AND '.join(clauses) + ' '
+    sql += f'ORDER BY {key} {direction}, {tie} {direction} LIMIT ? OFFSET ?'
+    return sql, [_online_since(online_minutes)] + params + [page_size, offset]
+
+
+def get_users_page(page_size, offset=0, after=None, online_minutes=5, filters=None, sort='join_date', descending=True):
+    """One page of users matching `filters` (see _user_filters), in `sort` order (see USER_SORTS).
+
+    Column 5 is the profile photo's file_unique_id, column 6 the user's
+    labels as a JSON array; each row ends with an
+    is_online flag, join_ts and the sort key. Pass
+    `after=(sort key, user_id)` of the last row seen for keyset pagination
+    instead of OFFSET.
+    """
+    label = (filters or {}).get('label')
+    label_users = get_label_counts([label]).get(label, 0) if label is not None and sort != 'join_date' else None
+    sql, params = _users_page_query(page_size, offset, after, online_minutes, filters, sort, descending, label_users)
+    with connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+# Plan-checked by migrations.check_query_plans, built by the code get_users_page runs
+migrations.HOT_QUERIES.update({f'get_users_page ({name})': _users_page_query(20, **args) for name, args in {
+    'join date': {},
+    'join date, cursor': {'after': (0, 0)},
+    'oldest first': {'descending': False},
+    'joined range': {'filters': {'joined_from': 0, 'joined_to': 1 << 40}},
+    'label': {'filters': {'label': 'vip'}},
+    'label, cursor': {'filters': {'label': 'vip'}, 'after': (0, 0)},
+    'label, joined range': {'filters': {'label': 'vip', 'joined_from': 0}},
+    'label by name': {'filters': {'label': 'vip'}, 'sort': 'name', 'label_users': SMALL_LABEL},
+    'by name, cursor': {'sort': 'name', 'descending': False, 'after': ('a', 0)},
+    'by username': {'sort': 'username'},
+    'by activity': {'sort': 'last_activity'},
+    'invite link': {'filters': {'invite_link': 'https://t.me/+x'}},
+}.items()})
+# Name/username prefix pages sort their matches (found through both NOCASE indexes), so are not listed
+
+
+def set_user_photo(user_id, file_id, file_unique_id):
+    # Telegram ids only: /media/photo/<file_unique_id> resolves and caches the file when viewed
+    with connection() as conn:
+        conn.execute('UPDATE users SET photo_file_id = ?, photo_unique_id = ? WHERE user_id = ?', (file_id, file_unique_id, user_id))
+
+
+def get_profile_photo(file_unique_id):
+    """file_id of the profile photo with this file_unique_id, or None."""
+    with connection() as conn:
+        row = conn.execute('SELECT photo_file_id FROM users WHERE photo_unique_id = ? LIMIT 1', (file_unique_id,)).fetchone()
+    return row[0] if row else None
+
+
+def set_user_label(user_id, label):
+    """Make `label` the user's only label (none if empty)."""
+    with transaction() as conn:
+        conn.execute('DELETE FROM user_labels WHERE user_id = ?', (user_id,))
+        if label:
+            label_users([label], user_ids=[user_id])
+
+
+# --- Labels ---
+
+def _label_ids(conn, names, create):
+    """{name: label id}; unknown names are created, or left out if not `create`."""
+    if create:
+        conn.executemany('INSERT OR IGNORE INTO labels (name) VALUES (?)', [(n,) for n in names])
+    return dict(conn.execute(f"SELECT name, id FROM labels WHERE name IN ({', '.join('?' * len(names))})", names).fetchall())
+
+
+def label_users(names, user_ids=None, filters=None, remove=False):
+    """Add (or remove) labels for the given user ids, or for every user matching `filters`, in one transaction.
+
+    Returns how many (user, label) pairs changed. Unknown user ids are skipped.
+    """
+    now = int(time.time())
+    changed = 0
+    with transaction() as conn:
+        label_ids = list(_label_ids(conn, names, create=not remove).values())
+        if user_ids is not None:
+            if remove:
+                changed = conn.executemany('DELETE FROM user_labels WHERE user_id = ? AND label_id = ?',
+                                           [(u, l) for l in label_ids for u in user_ids]).rowcount
+            else:
+                changed = conn.executemany('INSERT OR IGNORE INTO user_labels (user_id, label_id, created_ts, join_ts) '
+                                           'SELECT user_id, ?, ?, join_ts FROM users WHERE user_id = ?',
+                                           [(l, now, u) for l in label_ids for u in user_ids]).rowcount
+        else:
+            clauses, params = _user_filters(filters)
+            where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+            # Set-based: one statement per label however many users match
+            for label_id in label_ids:
+                if remove:
+                    changed += conn.execute('DELETE FROM user_labels WHERE label_id = ? '
+                                            f'AND user_id IN (SELECT user_id FROM users {where})', [label_id] + params).rowcount
+                else:
+                    changed += conn.execute('INSERT OR IGNORE INTO user_labels (user_id, label_id, created_ts, join_ts) '
+                                            f'SELECT user_id, ?, ?, join_ts FROM users {where}', [label_id, now] + params).rowcount
+    return changed
+
+
+_IMPORT_USER = '''INSERT INTO users (user_id, full_name, username, join_date, join_ts, invite_link)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        full_name = COALESCE(NULLIF(excluded.full_name, ''), users.full_name),
+        username = COALESCE(NULLIF(excluded.username, ''), users.username),
+        invite_link = COALESCE(users.invite_link, excluded.invite_link)'''
+
+
+def import_users(rows):
+    """Upsert (user_id, full_name, username, join_date, join_ts, invite_link, labels) rows in one transaction.
+
+    Existing users keep their join_date (and invite link, if they have one);
+    empty names do not overwrite, and labels are added to the ones they carry.
+    """
+    now = int(time.time())
+    with transaction() as conn:
+        conn.executemany(_IMPORT_USER, [row[:6] for row in rows])
+        names = sorted({name for row in rows for name in row[6]})
+        if names:
+            label_ids = _label_ids(conn, names, create=True)
+            conn.executemany('INSERT OR IGNORE INTO user_labels (user_id, label_id, created_ts, join_ts) '
+                             'SELECT user_id, ?, ?, join_ts FROM users WHERE user_id = ?',
+                             [(label_ids[name], now, row[0]) for row in rows for name in row[6]])
+
+
+def get_label_counts(names=None):
+    """{label name: users carrying it}, from the trigger-kept counts."""
+    sql = 'SELECT name, users FROM labels'
+    if names:
+        sql += f" WHERE name IN ({', '.join('?' * len(names))})"
+    with connection() as conn:
+        return dict(conn.execute(sql + ' ORDER BY name', names or ()).fetchall())
+
+
+def get_new_joins_today():
+    with connection() as conn:
+        row = conn.execute('SELECT joins FROM stats_day WHERE day = ?', (datetime.date.today().isoformat(),)).fetchone()
+    return row[0] if row else 0
+
+
+# --- Messages ---
+
+_INSERT_MESSAGE = 'INSERT INTO messages (user_id, sender, message, timestamp, ts, kind, payload) VALUES (?, ?, ?, ?, ?, ?, ?)'
+ATTACHMENT_FIELDS = ('kind', 'file_id', 'file_unique_id', 'file_path', 'file_size', 'mime_type')
+# file_path is a Bot API download detail, /media resolves it server-side; exports leave it out
+EXPORT_ATTACHMENT_FIELDS = ('id', 'kind', 'file_id', 'file_unique_id', 'file_size', 'mime_type')
+
+
+def _dump_payload(payload):
+    return json.dumps(payload, separators=(',', ':')) if payload else None
+
+
+def _insert_attachments(conn, message_id, attachments):
+    conn.executemany('INSERT INTO attachments (message_id, position, kind, file_id, file_unique_id, file_path, file_size, mime_type) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     [(message_id, i, *(a.get(f) for f in ATTACHMENT_FIELDS)) for i, a in enumerate(attachments)])
+
+
+def save_message(user_id, sender, message, timestamp=None, kind='text', payload=None, attachments=()):
     if timestamp is None:
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)', (user_id, sender, message, timestamp))
-    conn.commit()
-    conn.close()
-
-def get_messages_for_user(user_id, limit=100):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT sender, message, timestamp FROM messages WHERE user_id = ? ORDER BY id ASC LIMIT ?', (user_id, limit))
-    messages = c.fetchall()
-    conn.close()
-    return messages 
\ No newline at end of file
+        ts = int(time.time())
+        timestamp = from_ts(ts)
+    else:
+        ts = to_ts(timestamp)
+    # users.last_activity and the stats tables are kept up to date by triggers (see migrations.py)
+    with transaction() as conn:
+        message_id = conn.execute(_INSERT_MESSAGE, (user_id, sender, message, timestamp, ts, kind, _dump_payload(payload))).lastrowid
+        if attachments:
+            _insert_attachments(conn, message_id, attachments)
+
+
+def save_messages(rows):
+    """Insert many (user_id, sender, message, timestamp, ts, kind, payload, attachments) rows in one transaction.
+
+    Returns the new message ids, in row order. Consecutive rows without
+    attachments go in with one executemany.
+    """
+    ids = []
+    with transaction() as conn:
+        for has_attachments, group in groupby(rows, key=lambda row: bool(row[7])):
+            group = list(group)
+            if has_attachments:
+                for row in group:
+                    message_id = conn.execute(_INSERT_MESSAGE, row[:6] + (_dump_payload(row[6]),)).lastrowid
+                    _insert_attachments(conn, message_id, row[7])
+                    ids.append(message_id)
+                continue
+            conn.executemany(_INSERT_MESSAGE, [row[:6] + (_dump_payload(row[6]),) for row in group])
+            # The write lock is held, so the AUTOINCREMENT ids of the run are consecutive
+            last = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            ids.extend(range(last - len(group) + 1, last + 1))
+    return ids
+
+
+def _attachments_for(conn, message_ids):
+    attachments = {}
+    if not message_ids:
+        return attachments
+    placeholders = ','.join('?' * len(message_ids))
+    for row in conn.execute(f'SELECT message_id, id, {", ".join(ATTACHMENT_FIELDS)} FROM attachments '
+                            f'WHERE message_id IN ({placeholders}) ORDER BY message_id, position', message_ids):
+        attachments.setdefault(row[0], []).append(dict(zip(('id',) + ATTACHMENT_FIELDS, row[1:])))
+    return attachments
+
+
+def get_attachment(file_unique_id=None, attachment_id=None):
+    """An attachment dict by Telegram file_unique_id, or by row id for legacy rows without one."""
+    column, value = ('file_unique_id', file_unique_id) if file_unique_id is not None else ('id', attachment_id)
+    with connection() as conn:
+        row = conn.execute(f'SELECT id, {", ".join(ATTACHMENT_FIELDS)} FROM attachments WHERE {column} = ? '
+                           'ORDER BY id DESC LIMIT 1', (value,)).fetchone()
+    return dict(zip(('id',) + ATTACHMENT_FIELDS, row)) if row else None
+
+
+def _message_dict(row, attachments):
+    message_id, sender, kind, text, payload, timestamp, delivery_status = row
+    if kind is None:
+        # Saved before m008 and not converted yet
+        kind, text, legacy = migrations.parse_legacy_message(text)
+        attachments = [{f: a.get(f) for f in ('id',) + ATTACHMENT_FIELDS} for a in legacy]
+    return {
+        'id': message_id,
+        'sender': sender,
+        'kind': kind,
+        'text': text,
+        'timestamp': timestamp,
+        'delivery_status': delivery_status,
+        'payload': json.loads(payload) if payload else None,
+        'attachments': attachments
+    }
+
+
+_HISTORY_COLUMNS = 'SELECT id, sender, kind, message, payload, timestamp, delivery_status FROM messages WHERE user_id = ?'
+
+
+def get_chat_history(user_id, limit=100, before_id=None, after_id=None):
+    """One page of typed messages for a chat, newest first, and whether more exist in that direction.
+
+    By default the latest page; before_id pages back in time, after_id returns
+    only messages newer than it (oldest of them first if there are more than
+    `limit`). Every variant is a range scan on idx_messages_user_id.
+    """
+    with connection() as conn:
+        if after_id is not None:
+            rows = conn.execute(_HISTORY_COLUMNS + ' AND id > ? ORDER BY id ASC LIMIT ?', (user_id, after_id, limit + 1)).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit][::-1]
+        else:
+            if before_id is not None:
+                rows = conn.execute(_HISTORY_COLUMNS + ' AND id < ? ORDER BY id DESC LIMIT ?', (user_id, before_id, limit + 1)).fetchall()
+            else:
+                rows = conn.execute(_HISTORY_COLUMNS + ' ORDER BY id DESC LIMIT ?', (user_id, limit + 1)).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+        attachments = _attachments_for(conn, [r[0] for r in rows if r[2] not in (None, 'text')])
+    return [_message_dict(r, attachments.get(r[0], [])) for r in rows], has_more
+
+
+def convert_legacy_messages(limit=500):
+    with connection() as conn:
+        return migrations.convert_legacy_messages(conn, limit)
+
+
+def backfill_search(limit=2000):
+    with connection() as conn:
+        return migrations.backfill_search(conn, limit)
+
+
+SNIPPET_MARKS = ('[', ']')
+SNIPPET_TOKENS = 12
+
+
+def search_messages(match, user_id=None, sender=None, since=None, until=None, kinds=None, order='rank',
+                    after=None, limit=20):
+    """Messages matching an FTS5 query, best match first (order='rank') or newest first ('recent').
+
+    since/until are epoch seconds (until exclusive). `after` is the cursor of
+    the last result seen: (rank, id) for 'rank', the id for 'recent'. Each
+    result carries a snippet with the matched terms in SNIPPET_MARKS.
+    """
+    sql = ('SELECT m.id, m.user_id, u.full_name, u.username, m.sender, m.kind, m.timestamp, '
+           "snippet(messages_fts, 0, ?, ?, '…', ?), messages_fts.rank "
+           'FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid LEFT JOIN users u ON u.user_id = m.user_id '
+           'WHERE messages_fts MATCH ? ')
+    params = [*SNIPPET_MARKS, SNIPPET_TOKENS, match]
+    for clause, value in (('m.user_id = ?', user_id), ('m.sender = ?', sender), ('m.ts >= ?', since), ('m.ts < ?', until)):
+        if value is not None:
+            sql += 'AND ' + clause + ' '
+            params.append(value)
+    if kinds:
+        sql += f"AND m.kind IN ({', '.join('?' * len(kinds))}) "
+        params += list(kinds)
+    if order == 'recent':
+        if after is not None:
+            sql += 'AND messages_fts.rowid < ? '
+            params.append(after)
+        sql += 'ORDER BY messages_fts.rowid DESC LIMIT ?'
+    else:
+        if after is not None:
+            sql += 'AND (messages_fts.rank > ? OR (messages_fts.rank = ? AND messages_fts.rowid > ?)) '
+            params += [after[0], after[0], after[1]]
+        sql += 'ORDER BY messages_fts.rank, messages_fts.rowid LIMIT ?'
+    params.append(limit)
+    with connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return [{
+        'id': r[0],
+        'user_id': r[1],
+        'full_name': r[2],
+        'username': r[3],
+        'sender': r[4],
+        'kind': r[5],
+        'timestamp': r[6],
+        'snippet': r[7],
+        'rank': r[8]
+    } for r in rows]
+
+
+def get_conversations(admin, limit=50, before=None, online_minutes=5):
+    """Chats with the most recent message first, with `admin`'s unread count.
+
+    Pass `before=<last_message_id>` of the last conversation seen for the next page.
+    """
+    sql = (f'SELECT c.user_id, u.full_name, u.username, u.photo_unique_id, {_labels_of("c.user_id")}, COALESCE(u.last_activity >= ?, 0), '
+           'c.last_message_id, c.last_sender, c.last_kind, c.last_preview, c.last_ts, '
+           'c.user_messages - COALESCE(r.read_messages, c.read_baseline) '
+           'FROM conversations c '
+           'LEFT JOIN conversation_reads r ON r.admin = ? AND r.user_id = c.user_id '
+           'LEFT JOIN users u ON u.user_id = c.user_id ')
+    params = [_online_since(online_minutes), admin]
+    if before is not None:
+        sql += 'WHERE c.last_message_id < ? '
+        params.append(before)
+    sql += 'ORDER BY c.last_message_id DESC LIMIT ?'
+    params.append(limit)
+    with connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return [{
+        'user_id': r[0],
+        'full_name': r[1],
+        'username': r[2],
+        'photo_unique_id': r[3],
+        'labels': sorted(json.loads(r[4])) if r[4] else [],
+        'is_online': bool(r[5]),
+        'last_message': {'id': r[6], 'sender': r[7], 'kind': r[8], 'preview': r[9], 'timestamp': from_ts(r[10])},
+        'unread': max(r[11], 0)
+    } for r in rows]
+
+
+def mark_conversation_read(admin, user_id):
+    """Mark everything in the chat as read by `admin`; False if the chat has no messages."""
+    with connection() as conn:
+        return conn.execute('INSERT INTO conversation_reads (admin, user_id, read_messages, last_read_id, read_ts) '
+                            'SELECT ?, user_id, user_messages, last_message_id, ? FROM conversations WHERE user_id = ? '
+                            'ON CONFLICT(admin, user_id) DO UPDATE SET read_messages = excluded.read_messages, '
+                            'last_read_id = excluded.last_read_id, read_ts = excluded.read_ts',
+                            (admin, int(time.time()), user_id)).rowcount > 0
+
+
+# --- Export ---
+
+EXPORT_CHUNK = 1000
+
+
+def iter_users(filters=None, chunk=EXPORT_CHUNK):
+    """Yield lists of user dicts matching `filters` (see _user_filters), in user_id order.
+
+    One short keyset query per chunk, so memory stays flat and no read
+    transaction is held open while the caller streams.
+    """
+    clauses, params = _user_filters(filters)
+    where = ''.join(' AND ' + c for c in clauses)
+    last = -1 << 63
+    while True:
+        with connection() as conn:
+            rows = conn.execute(f'SELECT user_id, full_name, username, join_date, invite_link, {_labels_of("users.user_id")}, '
+                                f'last_activity FROM users WHERE user_id > ?{where} ORDER BY user_id LIMIT ?',
+                                [last] + params + [chunk]).fetchall()
+        if not rows:
+            return
+        yield [{
+            'user_id': r[0],
+            'full_name': r[1],
+            'username': r[2],
+            'join_date': r[3],
+            'invite_link': r[4],
+            'labels': sorted(json.loads(r[5])),
+            'last_activity': from_ts(r[6])
+        } for r in rows]
+        if len(rows) < chunk:
+            return
+        last = rows[-1][0]
+
+
+def iter_messages(user_id=None, since=None, until=None, chunk=EXPORT_CHUNK):
+    """Yield lists of typed message dicts (as get_chat_history, plus user_id and minus attachment file_path), oldest first.
+
+    since/until are epoch seconds (until exclusive). Keyset chunks on
+    idx_messages_user_id for one user, idx_messages_ts for a date range and the
+    primary key otherwise.
+    """
+    columns = 'SELECT id, sender, kind, message, payload, timestamp, delivery_status, user_id, ts FROM messages WHERE '
+    bounds, bound_params = [], []
+    if since is not None:
+        bounds.append('ts >= ?')
+        bound_params.append(since)
+    if until is not None:
+        bounds.append('ts < ?')
+        bound_params.append(until)
+    by_ts = user_id is None and bounds
+    position = None
+    while True:
+        if user_id is not None:
+            sql = columns + ' AND '.join(['user_id = ? AND id > ?'] + bounds) + ' ORDER BY id LIMIT ?'
+            params = [user_id, position or 0] + bound_params + [chunk]
+        elif by_ts:
+            clauses, params = list(bounds), list(bound_params)
+            if position is not None:
+                clauses.append('(ts, user_id, id) > (?, ?, ?)')
+                params += list(position)
+            sql = columns + ' AND '.join(clauses) + ' ORDER BY ts, user_id, id LIMIT ?'
+            params.append(chunk)
+        else:
+            sql = columns + 'id > ? ORDER BY id LIMIT ?'
+            params = [position or 0, chunk]
+        with connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+            attachments = _attachments_for(conn, [r[0] for r in rows if r[2] not in (None, 'text')])
+        if not rows:
+            return
+        messages = [dict(_message_dict(r[:7], attachments.get(r[0], [])), user_id=r[7]) for r in rows]
+        for message in messages:
+            message['attachments'] = [{f: a.get(f) for f in EXPORT_ATTACHMENT_FIELDS} for a in message['attachments']]
+        yield messages
+        if len(rows) < chunk:
+            return
+        last = rows[-1]
+        position = (last[8], last[7], last[0]) if by_ts else last[0]
+
+
+def get_last_activity(user_id):
+    """Epoch seconds of the user's last message, or None."""
+    with connection() as conn:
+        row = conn.execute('SELECT last_activity FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def get_last_activities(user_ids, chunk=500):
+    """{user_id: epoch seconds of the last message} for the given users; users never seen are left out."""
+    result = {}
+    user_ids = list(user_ids)
+    with connection() as conn:
+        for i in range(0, len(user_ids), chunk):
+            part = user_ids[i:i + chunk]
+            result.update(conn.execute(f"SELECT user_id, last_activity FROM users WHERE user_id IN ({','.join('?' * len(part))}) "
+                                       'AND last_activity IS NOT NULL', part).fetchall())
+    return result
+
+
+def get_total_messages():
+    return _get_counter('messages')
+
+
+def get_active_users(minutes=60):
+    """Users who sent a message in the last N minutes (index range over users.last_activity)."""
+    since = _online_since(minutes)
+    with connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM users WHERE last_activity >= ?', (since,)).fetchone()[0]
+
+
+# --- Dashboard aggregates (maintained at write time by triggers) ---
+
+STATS_MINUTE_RETENTION = 2 * 86400
+_last_stats_prune = 0
+
+
+def _get_counter(name):
+    with connection() as conn:
+        row = conn.execute('SELECT value FROM stats_counters WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def get_dashboard_stats(active_minutes=60):
+    with connection() as conn:
+        counters = {name: (value, updated_ts) for name, value, updated_ts in conn.execute(
+            "SELECT name, value, updated_ts FROM stats_counters WHERE name IN ('users', 'messages')")}
+    _prune_minute_stats()
+    users, users_ts = counters.get('users', (0, None))
+    messages, messages_ts = counters.get('messages', (0, None))
+    updated = [ts for ts in (users_ts, messages_ts) if ts is not None]
+    as_of = max(updated) if updated else None
+    return {
+        'total_users': users,
+        'active_users': get_active_users(active_minutes),
+        'total_messages': messages,
+        'new_joins_today': get_new_joins_today(),
+        # Counters are updated in the same transaction as the rows they count
+        'as_of': from_ts(as_of),
+        'age_seconds': int(time.time()) - as_of if as_of else None,
+        'generated_at': now_str()
+    }
+
+
+def get_stats_series(bucket='minute', since=None):
+    """Rollup buckets: [(minute epoch | 'YYYY-MM-DD', messages, joins), ...] oldest first."""
+    with connection() as conn:
+        if bucket == 'day':
+            since = since or (datetime.date.today() - datetime.timedelta(days=30)).isoformat()
+            return conn.execute('SELECT day, messages, joins FROM stats_day WHERE day >= ? ORDER BY day', (since,)).fetchall()
+        since = since if since is not None else int(time.time()) - 3600
+        return conn.execute('SELECT minute, messages, joins FROM stats_minute WHERE minute >= ? ORDER BY minute', (since,)).fetchall()
+
+
+def _prune_minute_stats():
+    # Minute buckets are only kept for a couple of days; day buckets are kept forever
+    global _last_stats_prune
+    now = time.time()
+    if now - _last_stats_prune < 3600:
+        return
+    _last_stats_prune = now
+    with connection() as conn:
+        conn.execute('DELETE FROM stats_minute WHERE minute < ?', (int(now) - STATS_MINUTE_RETENTION,))
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+WORKERS = 8
+MAX_QUEUE = 1000
+DRAIN_TIMEOUT = 10
+
+
+def update_key(data):
+    """The user (or chat) a raw update belongs to; updates with the same key are handled in order."""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('chat') or {}
+            if 'id' in sender:
+                return sender['id']
+    return data.get('update_id')
+
+
+class UpdateDispatcher:
+    """Bounded, concurrent processing of raw Telegram updates.
+
+    Each update is routed to one of `workers` shards by update_key(): one user's
+    updates are handled one at a time in arrival order, while different users
+    are processed in parallel. put_nowait() refuses updates when the shard is
+    full so the webhook can answer 503 and Telegram retries later.
+    """
+
+    def __init__(self, handler, workers=WORKERS, max_queue=MAX_QUEUE):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queues = []
+        self.tasks = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def start(self):
+        """Start the workers; call from the event loop."""
+        per_shard = max(self.max_queue // self.workers, 1)
+        self.queues = [asyncio.Queue(maxsize=per_shard) for _ in range(self.workers)]
+        self.tasks = [asyncio.create_task(self._worker(q)) for q in self.queues]
+
+    def put_nowait(self, data):
+        """Queue an update; returns False when its shard is full. Call from the event loop."""
+        queue = self.queues[hash(update_key(data)) % self.workers]
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    async def join(self):
+        for queue in self.queues:
+            await queue.join()
+
+    async def stop(self, drain_timeout=DRAIN_TIMEOUT):
+        """Finish what is queued (up to drain_timeout seconds), then stop the workers."""
+        try:
+            await asyncio.wait_for(self.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"Update dispatcher stopped with {sum(q.qsize() for q in self.queues)} updates unprocessed")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def metrics(self):
+        done = self.processed + self.failed
+        return {
+            'workers': self.workers,
+            'queue_depth': sum(q.qsize() for q in self.queues),
+            'queue_capacity': self.max_queue,
+            'received': self.received,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'avg_handle_ms': round(self.total_ms / done, 2) if done else 0.0,
+            'max_handle_ms': round(self.max_ms, 2)
+        }
+
+    async def _worker(self, queue):
+        while True:
+            data = await queue.get()
+            start = time.perf_counter()
+            try:
+                await self.handler(data)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Update {data.get('update_id')} failed: {e}")
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000
+                self.total_ms += elapsed
+                self.max_ms = max(self.max_ms, elapsed)
+                queue.task_done()
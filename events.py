@@ -0,0 +1,61 @@
+import threading
+import uuid
+from collections import deque
+
+EVENT_BUFFER = 5000  # events kept for clients that reconnect
+INBOX_ROOM = 'inbox'  # dashboards showing the conversation list
+
+
+def chat_room(user_id):
+    return f'chat_{user_id}'
+
+
+class EventStream:
+    """Room-scoped Socket.IO events with increasing ids.
+
+    emit() stamps each event with event_id (and the process epoch) and keeps
+    the last `size` of them, so a client that reconnects can ask for what it
+    missed with replay() instead of reloading everything. A client in several
+    target rooms still gets an event once.
+    """
+
+    def __init__(self, socketio, size=EVENT_BUFFER):
+        self.socketio = socketio
+        self.epoch = uuid.uuid4().hex[:12]  # changes on restart, when ids start over
+        self.buffer = deque(maxlen=size)  # (event_id, event, data, rooms)
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.emitted = 0
+        self.replayed = 0
+        self.resyncs = 0
+
+    def emit(self, event, data, rooms):
+        rooms = frozenset([rooms] if isinstance(rooms, str) else rooms)
+        with self.lock:
+            # Under the lock so every client sees events in id order
+            self.last_id += 1
+            data = dict(data, event_id=self.last_id, epoch=self.epoch)
+            self.buffer.append((self.last_id, event, data, rooms))
+            self.emitted += 1
+            self.socketio.emit(event, data, to=list(rooms))
+
+    def replay(self, last_id, epoch, rooms):
+        """[(event, data)] sent to any of `rooms` after last_id, or None if that gap can no longer be filled."""
+        rooms = set(rooms)
+        with self.lock:
+            if epoch != self.epoch or last_id > self.last_id or (self.buffer and self.buffer[0][0] > last_id + 1):
+                self.resyncs += 1
+                return None
+            missed = [(event, data) for event_id, event, data, to in self.buffer if event_id > last_id and to & rooms]
+            self.replayed += len(missed)
+            return missed
+
+    def metrics(self):
+        return {
+            'epoch': self.epoch,
+            'last_event_id': self.last_id,
+            'buffered': len(self.buffer),
+            'emitted': self.emitted,
+            'replayed': self.replayed,
+            'resyncs': self.resyncs
+        }
@@ -0,0 +1,49 @@
+import csv
+import io
+import json
+import zlib
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+GZIP_LEVEL = 6
+
+USER_COLUMNS = ('user_id', 'full_name', 'username', 'join_date', 'invite_link', 'labels', 'last_activity')
+MESSAGE_COLUMNS = ('id', 'user_id', 'sender', 'kind', 'text', 'timestamp', 'delivery_status', 'payload', 'attachments')
+
+
+def _csv_value(value):
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return ';'.join(value)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    return value
+
+
+def encode(chunks, columns, fmt):
+    """Yield CSV (header first) or NDJSON text, one piece per chunk of row dicts."""
+    if fmt == 'ndjson':
+        for rows in chunks:
+            yield ''.join(json.dumps({c: row[c] for c in columns}, ensure_ascii=False) + '\n' for row in rows)
+        return
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    # The header goes out before the first query runs
+    yield buf.getvalue()
+    for rows in chunks:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows([_csv_value(row[c]) for c in columns] for row in rows)
+        yield buf.getvalue()
+
+
+def stream(chunks, columns, fmt, compress=False):
+    """Bytes for a streamed export: encoded chunk by chunk, gzipped on the fly if asked."""
+    if not compress:
+        for text in encode(chunks, columns, fmt):
+            yield text.encode()
+        return
+    gz = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for text in encode(chunks, columns, fmt):
+        # Sync flush so every chunk reaches the client now rather than when the buffer fills
+        yield gz.compress(text.encode()) + gz.flush(zlib.Z_SYNC_FLUSH)
+    yield gz.flush()
@@ -0,0 +1,205 @@
+"""Bulk import of existing members into users, streamed and resumable.
+
+    python importer.py members.csv[.gz] [--format csv|ndjson] [--label imported] [--resume JOB_ID]
+
+CSV needs a header row; NDJSON holds one object per line. Recognised fields:
+user_id (required), full_name, username, join_date ('YYYY-MM-DD[ HH:MM:SS]',
+ISO 8601 or epoch seconds; default now), invite_link and labels (a list, or
+';'-separated in CSV). Rows are validated and upserted BATCH_SIZE at a time;
+existing users keep their join_date. Each batch commits together with the
+job's position, so after an interruption --resume (or ?resume= on
+POST /import/users) with the same source skips exactly the rows already in.
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import json
+import time
+
+from db import connection, import_users, transaction
+
+BATCH_SIZE = 5000
+MAX_ERRORS = 100  # invalid rows reported per job
+MAX_LABEL_LENGTH = 64
+FORMATS = ('csv', 'ndjson')
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+class RowError(ValueError):
+    pass
+
+
+def read_rows(stream, fmt, compressed=False):
+    """Yield one dict per row of a binary CSV/NDJSON stream; bad NDJSON lines yield a RowError."""
+    if compressed:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        yield from csv.DictReader(text)
+        return
+    for line in text:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield RowError(f'invalid JSON: {e}')
+            continue
+        yield row if isinstance(row, dict) else RowError('not a JSON object')
+
+
+def parse_join_date(value):
+    if value in (None, ''):
+        return int(time.time())
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return int(value)
+    text = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return int(datetime.datetime.strptime(text[:19], fmt).timestamp())
+        except ValueError:
+            pass
+    raise RowError(f'invalid join_date {text!r}')
+
+
+def validate(row, extra_labels=()):
+    """(user_id, full_name, username, join_date, join_ts, invite_link, labels) for import_users, or RowError."""
+    if isinstance(row, Exception):
+        raise row
+    try:
+        user_id = int(row.get('user_id'))
+    except (TypeError, ValueError):
+        raise RowError(f"invalid user_id {row.get('user_id')!r}")
+    if user_id <= 0:
+        raise RowError(f'invalid user_id {user_id}')
+    labels = row.get('labels') or []
+    if isinstance(labels, str):
+        labels = labels.split(';')
+    labels = {str(label).strip() for label in labels} | set(extra_labels)
+    labels.discard('')
+    if any(len(label) > MAX_LABEL_LENGTH for label in labels):
+        raise RowError(f'labels must be at most {MAX_LABEL_LENGTH} characters')
+    join_ts = parse_join_date(row.get('join_date'))
+    return (user_id, str(row.get('full_name') or '').strip(), str(row.get('username') or '').strip().lstrip('@'),
+            datetime.datetime.fromtimestamp(join_ts).strftime('%Y-%m-%d %H:%M:%S'), join_ts,
+            row.get('invite_link') or None, sorted(labels))
+
+
+# --- Jobs ---
+
+def create_job(source, fmt, labels=()):
+    now = int(time.time())
+    with connection() as conn:
+        return conn.execute('INSERT INTO imports (source, format, labels, status, created_ts, updated_ts) '
+                            "VALUES (?, ?, ?, 'running', ?, ?)", (source, fmt, json.dumps(list(labels)), now, now)).lastrowid
+
+
+def get_job(job_id):
+    with connection() as conn:
+        row = conn.execute('SELECT id, source, format, labels, status, position, imported, invalid, errors, created_ts, updated_ts '
+                           'FROM imports WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return None
+    return {
+        'job_id': row[0],
+        'source': row[1],
+        'format': row[2],
+        'labels': json.loads(row[3]) if row[3] else [],
+        'status': row[4],
+        'position': row[5],
+        'imported': row[6],
+        'invalid': row[7],
+        'errors': json.loads(row[8]) if row[8] else [],
+        'created_ts': row[9],
+        'updated_ts': row[10]
+    }
+
+
+def _set_status(job_id, status):
+    with connection() as conn:
+        conn.execute('UPDATE imports SET status = ?, updated_ts = ? WHERE id = ?', (status, int(time.time()), job_id))
+
+
+def _commit(job_id, batch, position, invalid, errors):
+    # The rows and the position that covers them land in the same transaction
+    with transaction() as conn:
+        if batch:
+            import_users(batch)
+        conn.execute('UPDATE imports SET position = ?, imported = imported + ?, invalid = invalid + ?, errors = ?, '
+                     'updated_ts = ? WHERE id = ?',
+                     (position, len(batch), invalid, json.dumps(errors), int(time.time()), job_id))
+
+
+def run_import(job_id, stream, compressed=False, batch_size=BATCH_SIZE, on_progress=None):
+    """Import `stream` into job `job_id`, skipping the rows a previous run already committed.
+
+    Returns the final job dict; on_progress(job dict) is called after every batch.
+    """
+    job = get_job(job_id)
+    _set_status(job_id, 'running')
+    skip, errors = job['position'], job['errors']
+    batch, invalid, position = [], 0, skip
+    try:
+        for position, row in enumerate(read_rows(stream, job['format'], compressed), start=1):
+            if position <= skip:
+                continue
+            try:
+                batch.append(validate(row, job['labels']))
+            except RowError as e:
+                invalid += 1
+                if len(errors) < MAX_ERRORS:
+                    errors.append({'row': position, 'error': str(e)})
+            if len(batch) + invalid >= batch_size:
+                _commit(job_id, batch, position, invalid, errors)
+                batch, invalid = [], 0
+                if on_progress is not None:
+                    on_progress(get_job(job_id))
+        _commit(job_id, batch, max(position, skip), invalid, errors)
+    except Exception:
+        # Committed batches stay; resume with the same source to continue after them
+        _set_status(job_id, 'interrupted')
+        raise
+    _set_status(job_id, 'completed')
+    job = get_job(job_id)
+    if on_progress is not None:
+        on_progress(job)
+    return job
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('file')
+    parser.add_argument('--format', choices=FORMATS, help='default: from the file extension')
+    parser.add_argument('--label', action='append', default=[], help='add this label to every imported user')
+    parser.add_argument('--resume', type=int, metavar='JOB_ID')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    import db
+    db.init_db()
+    if args.resume:
+        job = get_job(args.resume)
+        if job is None:
+            parser.error(f'no import job {args.resume}')
+        if job['status'] == 'completed':
+            parser.error(f'import job {args.resume} already completed')
+        job_id = job['job_id']
+        print(f"Resuming import {job_id} after row {job['position']}")
+    else:
+        fmt = args.format or ('ndjson' if any(ext in args.file for ext in ('.ndjson', '.jsonl')) else 'csv')
+        job_id = create_job(args.file, fmt, args.label)
+        print(f"Import job {job_id}")
+    start = time.perf_counter()
+    progress = lambda j: print(f"  row {j['position']}: {j['imported']} imported, {j['invalid']} invalid "
+                               f"({j['position'] / (time.perf_counter() - start):.0f} rows/s)")
+    with open(args.file, 'rb') as f:
+        job = run_import(job_id, f, args.file.endswith('.gz'), args.batch_size, on_progress=progress)
+    for error in job['errors'][:10]:
+        print(f"  row {error['row']}: {error['error']}")
+    print(f"Import {job_id} {job['status']}: {job['imported']} imported, {job['invalid']} invalid")
+
+
+if __name__ == '__main__':
+    main()
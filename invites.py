@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+from db import connection, transaction
+from runtime import run_blocking
+
+POOL_SIZE = 50
+LOW_WATER = 20  # refill once fewer links than this are left
+LINK_TTL = 30 * 86400
+MIN_VALIDITY = 86400  # links expiring sooner than this are not handed out
+REFILL_INTERVAL = 300
+MINT_INTERVAL = 0.5  # pause between create_chat_invite_link calls while refilling
+CREATE_TIMEOUT = 5  # inline mint when the pool is empty
+
+
+class InviteLinkPool:
+    """Single-use channel invite links minted ahead of time.
+
+    get_link() hands a user their earlier, still unused link or takes one from
+    the pool, so /start never waits on create_chat_invite_link. run() keeps the
+    pool topped up. Each link stays tied to the user it was given to, and
+    record_joins() marks it used when a chat_member update shows someone
+    joining through it (attribution).
+    """
+
+    def __init__(self, bot, chat_id, fallback_url, size=POOL_SIZE, low_water=LOW_WATER):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.fallback_url = fallback_url
+        self.size = size
+        self.low_water = low_water
+        self._refill = None
+        self.assigned = 0
+        self.reused = 0
+        self.misses = 0
+        self.minted = 0
+
+    async def get_link(self, user_id):
+        link = await run_blocking(self._take, user_id)
+        if link is None:
+            # Pool ran dry: mint one inline, bounded so /start still answers quickly
+            try:
+                link = await asyncio.wait_for(self._mint(user_id), CREATE_TIMEOUT)
+            except Exception as e:
+                print(f"Failed to create invite link for {user_id}: {e}")
+                link = self.fallback_url
+        if self._refill is not None:
+            self._refill.set()
+        return link
+
+    def _take(self, user_id):
+        valid_after = int(time.time()) + MIN_VALIDITY
+        with transaction() as conn:
+            row = conn.execute("SELECT invite_link FROM invite_links WHERE user_id = ? AND status = 'assigned' "
+                               "AND chat_id = ? AND expire_ts > ? LIMIT 1", (user_id, self.chat_id, valid_after)).fetchone()
+            if row is not None:
+                self.reused += 1
+                return row[0]
+            row = conn.execute("SELECT invite_link FROM invite_links WHERE chat_id = ? AND status = 'pool' AND expire_ts > ? "
+                               "ORDER BY expire_ts LIMIT 1", (self.chat_id, valid_after)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE invite_links SET status = 'assigned', user_id = ?, assigned_ts = ? WHERE invite_link = ?",
+                         (user_id, int(time.time()), row[0]))
+            self.assigned += 1
+            return row[0]
+
+    async def _mint(self, user_id=None):
+        expire_ts = int(time.time()) + LINK_TTL
+        chat = await self.bot.create_chat_invite_link(chat_id=self.chat_id, member_limit=1, expire_date=expire_ts,
+                                                      name=f"start {user_id}" if user_id else 'start pool')
+        await run_blocking(self._store, chat.invite_link, expire_ts, user_id)
+        self.minted += 1
+        return chat.invite_link
+
+    def _store(self, invite_link, expire_ts, user_id):
+        now = int(time.time())
+        with connection() as conn:
+            conn.execute('INSERT OR IGNORE INTO invite_links (invite_link, chat_id, status, user_id, created_ts, expire_ts, assigned_ts) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (invite_link, self.chat_id, 'assigned' if user_id else 'pool', user_id, now, expire_ts,
+                          now if user_id else None))
+
+    def available(self):
+        with connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM invite_links WHERE chat_id = ? AND status = 'pool' AND expire_ts > ?",
+                                (self.chat_id, int(time.time()) + MIN_VALIDITY)).fetchone()[0]
+
+    def record_joins(self, joins):
+        """Mark the links behind [(invite_link, user_id), ...] joins as used."""
+        now = int(time.time())
+        with transaction() as conn:
+            conn.executemany("UPDATE invite_links SET status = 'used', used_by = ?, used_ts = ? WHERE invite_link = ? AND status != 'used'",
+                             [(user_id, now, invite_link) for invite_link, user_id in joins if invite_link])
+
+    async def run(self):
+        self._refill = asyncio.Event()
+        while True:
+            try:
+                await self._top_up()
+            except Exception as e:
+                print(f"Invite link refill failed: {e}")
+            self._refill.clear()
+            try:
+                await asyncio.wait_for(self._refill.wait(), timeout=REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _top_up(self):
+        available = await run_blocking(self.available)
+        if available >= self.low_water:
+            return
+        while available < self.size:
+            try:
+                await self._mint()
+            except RetryAfter as e:
+                await asyncio.sleep(float(e.retry_after))
+                continue
+            available += 1
+            await asyncio.sleep(MINT_INTERVAL)
+
+    def metrics(self):
+        return {
+            'available': self.available(),
+            'assigned': self.assigned,
+            'reused': self.reused,
+            'misses': self.misses,
+            'minted': self.minted
+        }
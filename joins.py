@@ -0,0 +1,203 @@
+import asyncio
+import datetime
+import time
+from collections import deque
+
+from pyrogram.errors import FloodWait
+
+from broadcast import GLOBAL_RATE
+from db import add_users
+from ratelimit import TokenBucket
+from runtime import run_blocking
+
+BULK_DELAY = 1.0  # seconds requests for a whitelisted link are collected before one approve-all call
+PERSIST_BATCH = 200
+PERSIST_INTERVAL = 0.5
+DM_WORKERS = 4
+DM_ATTEMPTS = 3
+MAX_DM_QUEUE = 50000
+SAMPLES = 2000  # latency samples kept for the percentiles
+
+
+def percentiles(samples):
+    if not samples:
+        return {'p50': None, 'p90': None, 'p99': None}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 3)
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99)}
+
+
+class JoinPipeline:
+    """Join-request handling split into three independent stages.
+
+    Requests are approved as soon as they arrive (in bulk with
+    approve_all_chat_join_requests for whitelisted invite links); the users are
+    written in batches; welcome DMs go through a rate-limited queue, so a flood
+    wait on DMs never holds up approvals.
+    """
+
+    def __init__(self, client, welcome_text, bucket=None, bulk_links=(), invites=None, dm_workers=DM_WORKERS):
+        self.client = client
+        self.invites = invites  # InviteLinkPool: joins through its links are attributed
+        self.welcome_text = welcome_text
+        self.bucket = bucket or TokenBucket(GLOBAL_RATE)
+        self.bulk_links = set(bulk_links)
+        self.dm_workers = dm_workers
+        self.dm_queue = None
+        self._bulk = {}  # (chat_id, invite_link) -> future resolved by the next approve-all call
+        self._bulk_runs = set()  # running _run_bulk tasks, kept referenced until done
+        self._pending_users = []
+        self._persist_now = None
+        self._tasks = []
+        self.approve_latency = deque(maxlen=SAMPLES)
+        self.dm_lag = deque(maxlen=SAMPLES)
+        self.approved = 0
+        self.approve_failed = 0
+        self.bulk_calls = 0
+        self.persisted = 0
+        self.dm_sent = 0
+        self.dm_failed = 0
+        self.dm_dropped = 0
+
+    # --- Stage 1: approval ---
+
+    async def handle(self, join_request):
+        user, chat = join_request.from_user, join_request.chat
+        link = join_request.invite_link.invite_link if join_request.invite_link else None
+        try:
+            if link in self.bulk_links:
+                await self._approve_bulk(chat.id, link)
+            else:
+                await self._approve(chat.id, user.id)
+        except Exception as e:
+            self.approve_failed += 1
+            print(f"Could not approve {user.first_name} ({user.id}) in {chat.title}: {e}")
+            return
+        approved = time.time()
+        self.approved += 1
+        if join_request.date:
+            self.approve_latency.append(approved - join_request.date.timestamp())
+
+        full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+        join_date = datetime.datetime.fromtimestamp(approved).strftime('%Y-%m-%d %H:%M:%S')
+        self._pending_users.append((user.id, full_name, user.username or '', join_date, link))
+        if len(self._pending_users) >= PERSIST_BATCH and self._persist_now is not None:
+            self._persist_now.set()
+        try:
+            self.dm_queue.put_nowait((user, chat.title, approved))
+        except asyncio.QueueFull:
+            self.dm_dropped += 1
+            print(f"Welcome DM queue full, skipping DM to {user.id}")
+
+    async def _approve(self, chat_id, user_id):
+        try:
+            await self.client.approve_chat_join_request(chat_id, user_id)
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+            await self.client.approve_chat_join_request(chat_id, user_id)
+
+    async def _approve_bulk(self, chat_id, link):
+        key = (chat_id, link)
+        waiter = self._bulk.get(key)
+        if waiter is None:
+            waiter = asyncio.get_running_loop().create_future()
+            self._bulk[key] = waiter
+            task = asyncio.create_task(self._run_bulk(key, waiter))
+            self._bulk_runs.add(task)
+            task.add_done_callback(self._bulk_runs.discard)
+        await asyncio.shield(waiter)
+
+    async def _run_bulk(self, key, waiter):
+        await asyncio.sleep(BULK_DELAY)
+        # Requests arriving from here on wait for the next round
+        del self._bulk[key]
+        chat_id, link = key
+        try:
+            await self.client.approve_all_chat_join_requests(chat_id, invite_link=link)
+            self.bulk_calls += 1
+            waiter.set_result(True)
+        except Exception as e:
+            waiter.set_exception(e)
+
+    # --- Stage 2: batched persistence ---
+
+    async def _persist_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._persist_now.wait(), timeout=PERSIST_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._persist_now.clear()
+            await self._persist()
+
+    async def _persist(self):
+        if not self._pending_users:
+            return
+        batch, self._pending_users = self._pending_users, []
+        try:
+            await run_blocking(add_users, batch)
+            self.persisted += len(batch)
+            if self.invites is not None:
+                await run_blocking(self.invites.record_joins, [(row[4], row[0]) for row in batch])
+        except Exception as e:
+            print(f"Could not save {len(batch)} joined users, will retry: {e}")
+            self._pending_users[:0] = batch
+
+    # --- Stage 3: welcome DMs ---
+
+    async def _dm_worker(self):
+        while True:
+            user, title, approved = await self.dm_queue.get()
+            try:
+                await self._send_welcome(user, title)
+                self.dm_sent += 1
+                self.dm_lag.append(time.time() - approved)
+            except Exception as e:
+                self.dm_failed += 1
+                print(f"Failed to send DM to {user.first_name} ({user.id}): {e}")
+            finally:
+                self.dm_queue.task_done()
+
+    async def _send_welcome(self, user, title):
+        text = self.welcome_text.format(mention=user.mention, title=title)
+        for attempt in range(DM_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                return await self.client.send_message(user.id, text)
+            except FloodWait as e:
+                if attempt == DM_ATTEMPTS - 1:
+                    raise
+                print(f"Welcome DM flood wait, pausing {e.value}s")
+                self.bucket.block(e.value)
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Start the persistence and DM tasks; call from the event loop."""
+        self.dm_queue = asyncio.Queue(maxsize=MAX_DM_QUEUE)
+        self._persist_now = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._persist_loop())]
+        self._tasks += [asyncio.create_task(self._dm_worker()) for _ in range(self.dm_workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._persist()
+        if self.dm_queue.qsize():
+            print(f"Stopping with {self.dm_queue.qsize()} welcome DMs unsent")
+
+    def metrics(self):
+        return {
+            'approved': self.approved,
+            'approve_failed': self.approve_failed,
+            'bulk_approve_calls': self.bulk_calls,
+            'approve_latency_seconds': percentiles(self.approve_latency),
+            'persist_pending': len(self._pending_users),
+            'persisted': self.persisted,
+            'dm_queue_depth': self.dm_queue.qsize() if self.dm_queue else 0,
+            'dm_sent': self.dm_sent,
+            'dm_failed': self.dm_failed,
+            'dm_dropped': self.dm_dropped,
+            'dm_lag_seconds': percentiles(self.dm_lag)
+        }
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import shutil
+import tempfile
+
+from telegram import InputMediaAudio, InputMediaPhoto, InputMediaVideo
+from werkzeug.utils import secure_filename
+
+from config import BOT_TOKEN
+
+MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+MAX_PHOTO_SIZE = 20 * 1024 * 1024  # 20MB
+MEDIA_GROUP_LIMIT = 10  # Telegram accepts at most 10 items per album
+
+# kind -> (single send method, its media kwarg, InputMedia class for albums or None)
+SENDERS = {
+    'image': ('send_photo', 'photo', InputMediaPhoto),
+    'video': ('send_video', 'video', InputMediaVideo),
+    'audio': ('send_audio', 'audio', InputMediaAudio),
+    'gif': ('send_animation', 'animation', None),  # animations cannot go in albums
+}
+
+
+class UploadError(Exception):
+    pass
+
+
+def file_url(file_path):
+    if file_path.startswith('http'):
+        return file_path
+    return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+
+
+def media_kind(mimetype):
+    mimetype = mimetype or ''
+    if mimetype == 'image/gif':
+        return 'gif'
+    if mimetype.startswith('image/'):
+        return 'image'
+    if mimetype.startswith('video/'):
+        return 'video'
+    if mimetype.startswith('audio/'):
+        return 'audio'
+    return None
+
+
+def spool_uploads(files):
+    """Stream uploaded files into a private temp dir.
+
+    Returns (tmp_dir, {kind: [path, ...]}). Each request gets its own directory,
+    so concurrent uploads with the same filename never collide. The caller owns
+    tmp_dir and must remove it (see cleanup()).
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='chat_upload_')
+    by_kind = {}
+    try:
+        for i, file in enumerate(files):
+            kind = media_kind(file.mimetype)
+            if kind is None:
+                print('Skipping unsupported upload:', file.filename, file.mimetype)
+                continue
+            file.stream.seek(0, os.SEEK_END)
+            size = file.stream.tell()
+            file.stream.seek(0)
+            if kind == 'image' and size > MAX_PHOTO_SIZE:
+                raise UploadError(f'Image {file.filename} is too large. Maximum size is 20MB.')
+            if size > MAX_FILE_SIZE:
+                raise UploadError(f'File {file.filename} is too large. Maximum size is 50MB.')
+            path = os.path.join(tmp_dir, f'{i}_{secure_filename(file.filename or "") or "upload"}')
+            file.save(path)
+            by_kind.setdefault(kind, []).append(path)
+    except BaseException:
+        cleanup(tmp_dir)
+        raise
+    return tmp_dir, by_kind
+
+
+def cleanup(tmp_dir):
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def message_attachment(msg):
+    """(kind, attachment dict) for the media in a Telegram message, or (None, None)."""
+    if msg.photo:
+        kind, media = 'image', msg.photo[-1]
+    else:
+        for kind, attr in (('video', 'video'), ('voice', 'voice'), ('audio', 'audio'), ('gif', 'animation')):
+            media = getattr(msg, attr, None)
+            if media:
+                break
+        else:
+            return None, None
+    return kind, {
+        'kind': kind,
+        'file_id': media.file_id,
+        'file_unique_id': getattr(media, 'file_unique_id', None),
+        'file_size': getattr(media, 'file_size', None),
+        'mime_type': 'image/jpeg' if kind == 'image' else getattr(media, 'mime_type', None)
+    }
+
+
+async def _send_kind(bot, chat_id, kind, paths):
+    method, kwarg, input_media = SENDERS[kind]
+    sent = []
+    if input_media is not None and len(paths) > 1:
+        # Even chunks (11 -> 5 + 6): send_media_group rejects a 1-item remainder
+        count = -(-len(paths) // MEDIA_GROUP_LIMIT)
+        bounds = [len(paths) * i // count for i in range(count + 1)]
+        for start, end in zip(bounds, bounds[1:]):
+            chunk = paths[start:end]
+            files = [open(p, 'rb') for p in chunk]
+            try:
+                media = [input_media(f, filename=os.path.basename(p)) for f, p in zip(files, chunk)]
+            finally:
+                for f in files:
+                    f.close()
+            sent.extend(await bot.send_media_group(chat_id=chat_id, media=media))
+    else:
+        async def send_single(path):
+            with open(path, 'rb') as f:
+                return await getattr(bot, method)(chat_id=chat_id, **{kwarg: f})
+        sent.extend(await asyncio.gather(*(send_single(p) for p in paths)))
+    return [message_attachment(msg)[1] for msg in sent]
+
+
+async def send_media(bot, chat_id, by_kind):
+    """Send every kind in parallel.
+
+    Returns the sent attachments (dicts as stored by db.save_message) in send order.
+    No get_file here: /media resolves the path when the file is first viewed, and
+    get_file refuses files over 20MB anyway.
+    """
+    results = await asyncio.gather(*(_send_kind(bot, chat_id, kind, paths) for kind, paths in by_kind.items()))
+    return [item for items in results for item in items if item]
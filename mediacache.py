@@ -0,0 +1,118 @@
+import os
+import shutil
+import threading
+import urllib.request
+from collections import OrderedDict
+
+CACHE_DIR = 'media_cache'
+MAX_CACHE_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
+DOWNLOAD_TIMEOUT = 60
+CHUNK_SIZE = 256 * 1024
+
+
+class MediaCache:
+    """Size-bounded LRU cache of Telegram files on local disk.
+
+    Files are named by their Telegram file_unique_id, which identifies the
+    content, so a cached file never goes stale and can be served with a strong
+    ETag. get() downloads on a miss (one download per file even when many
+    requests miss at once) and evicts least recently used files once the cache
+    exceeds max_bytes. Recency survives restarts through the files' mtime.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # name -> size, least recently used first
+        self.total = 0
+        self.lock = threading.Lock()
+        self._fetching = {}  # name -> lock held while it downloads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = self.path(name)
+            if name.startswith('.'):
+                # Partial download from a previous run
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total += size
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _hit(self, name):
+        self.entries.move_to_end(name)
+        self.hits += 1
+        os.utime(self.path(name))
+
+    def get(self, name, resolve):
+        """Local path of `name`; on a miss resolve() must return the URL to download it from."""
+        with self.lock:
+            if name in self.entries:
+                self._hit(name)
+                return self.path(name)
+            fetch_lock = self._fetching.setdefault(name, threading.Lock())
+        with fetch_lock:
+            with self.lock:
+                if name in self.entries:
+                    # Another request downloaded it while we waited
+                    self._hit(name)
+                    return self.path(name)
+                self.misses += 1
+            size = None
+            try:
+                size = self._download(resolve(), name)
+            finally:
+                # One lock block, so no request sees neither the fetch nor the entry
+                with self.lock:
+                    self._fetching.pop(name, None)
+                    if size is not None:
+                        self.entries[name] = size
+                        self.total += size
+                        self._evict(keep=name)
+        return self.path(name)
+
+    def _download(self, url, name):
+        tmp = self.path('.' + name + '.part')
+        try:
+            with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as resp, open(tmp, 'wb') as out:
+                shutil.copyfileobj(resp, out, CHUNK_SIZE)
+            os.replace(tmp, self.path(name))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return os.path.getsize(self.path(name))
+
+    def _evict(self, keep):
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            name, size = next(iter(self.entries.items()))
+            if name == keep:
+                break
+            del self.entries[name]
+            self.total -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
+
+    def metrics(self):
+        return {
+            'files': len(self.entries),
+            'bytes': self.total,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
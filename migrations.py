@@ -0,0 +1,611 @@
+"""Versioned schema migrations, tracked in PRAGMA user_version.
+
+Each migration runs in its own transaction together with the version bump, so
+a crash leaves the database at the last fully applied version. Run this file
+directly to migrate users.db and check that the hot queries use an index:
+
+    python migrations.py [--convert-messages] [--backfill-search]
+
+--convert-messages also converts pre-m008 message rows right away instead of
+leaving it to the background task in api.py; --backfill-search does the same
+for the m010 search index.
+"""
+import re
+import sys
+
+PREVIEW_LENGTH = 120  # characters of the last message kept on each conversation
+
+
+def _columns(c, table):
+    return [row[1] for row in c.execute(f'PRAGMA table_info({table})')]
+
+
+def _add_column(c, table, column, decl):
+    if column not in _columns(c, table):
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+
+def m001_base_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        full_name TEXT,
+        username TEXT,
+        join_date TEXT,
+        invite_link TEXT,
+        photo_url TEXT,
+        label TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        sender TEXT,
+        message TEXT,
+        timestamp TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message TEXT,
+        status TEXT,
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at TEXT,
+        updated_at TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        job_id INTEGER,
+        user_id INTEGER,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        error TEXT,
+        telegram_message_id INTEGER,
+        updated_at TEXT,
+        PRIMARY KEY (job_id, user_id)
+    ) WITHOUT ROWID''')
+
+
+def m002_user_columns(c):
+    # Databases created by the old db.py may predate label; last_activity is newer still
+    _add_column(c, 'users', 'label', 'TEXT')
+    if 'last_activity' not in _columns(c, 'users'):
+        c.execute('ALTER TABLE users ADD COLUMN last_activity INTEGER')
+        c.execute('''UPDATE users SET last_activity = (
+            SELECT MAX(timestamp) FROM messages WHERE messages.user_id = users.user_id AND sender = 'user')''')
+
+
+def m003_integer_timestamps(c):
+    # Text timestamps are local wall-clock time; the 'utc' modifier converts them to real epoch seconds.
+    # The text columns stay for display, the integer ones are what queries filter and sort on.
+    _add_column(c, 'messages', 'ts', 'INTEGER')
+    _add_column(c, 'users', 'join_ts', 'INTEGER')
+    c.execute("UPDATE messages SET ts = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) WHERE ts IS NULL")
+    c.execute("UPDATE users SET join_ts = CAST(strftime('%s', join_date, 'utc') AS INTEGER) WHERE join_ts IS NULL")
+    declared = {row[1]: row[2] for row in c.execute('PRAGMA table_info(users)')}
+    if declared['last_activity'].upper() != 'INTEGER':
+        # TEXT affinity would turn the epoch values back into strings: swap in an INTEGER column
+        c.execute('ALTER TABLE users RENAME COLUMN last_activity TO last_activity_text')
+        c.execute('ALTER TABLE users ADD COLUMN last_activity INTEGER')
+        c.execute('UPDATE users SET last_activity = last_activity_text')
+        c.execute('ALTER TABLE users DROP COLUMN last_activity_text')
+    c.execute("UPDATE users SET last_activity = CAST(strftime('%s', last_activity, 'utc') AS INTEGER) "
+              "WHERE typeof(last_activity) = 'text'")
+
+
+def m004_indexes(c):
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (ts, user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_join_ts ON users (join_ts, user_id)')
+
+
+def m005_stats_aggregates(c):
+    # Counters and rollup buckets maintained by triggers, so the dashboard never COUNTs big tables
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0,
+        updated_ts INTEGER
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_minute (
+        minute INTEGER PRIMARY KEY,
+        messages INTEGER NOT NULL DEFAULT 0,
+        joins INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_day (
+        day TEXT PRIMARY KEY,
+        messages INTEGER NOT NULL DEFAULT 0,
+        joins INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users (last_activity)')
+
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + 1, updated_ts = CAST(strftime('%s', 'now') AS INTEGER) WHERE name = 'users';
+        INSERT INTO stats_minute (minute, joins) VALUES (NEW.join_ts / 60 * 60, 1)
+            ON CONFLICT(minute) DO UPDATE SET joins = joins + 1;
+        INSERT INTO stats_day (day, joins) VALUES (date(NEW.join_ts, 'unixepoch', 'localtime'), 1)
+            ON CONFLICT(day) DO UPDATE SET joins = joins + 1;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET value = value - 1, updated_ts = CAST(strftime('%s', 'now') AS INTEGER) WHERE name = 'users';
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_messages_insert AFTER INSERT ON messages BEGIN
+        UPDATE stats_counters SET value = value + 1, updated_ts = CAST(strftime('%s', 'now') AS INTEGER) WHERE name = 'messages';
+        INSERT INTO stats_minute (minute, messages) VALUES (NEW.ts / 60 * 60, 1)
+            ON CONFLICT(minute) DO UPDATE SET messages = messages + 1;
+        INSERT INTO stats_day (day, messages) VALUES (date(NEW.ts, 'unixepoch', 'localtime'), 1)
+            ON CONFLICT(day) DO UPDATE SET messages = messages + 1;
+        UPDATE users SET last_activity = NEW.ts WHERE NEW.sender = 'user' AND user_id = NEW.user_id;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_messages_delete AFTER DELETE ON messages BEGIN
+        UPDATE stats_counters SET value = value - 1, updated_ts = CAST(strftime('%s', 'now') AS INTEGER) WHERE name = 'messages';
+    END''')
+
+    # Seed from the existing rows (one last full scan)
+    c.execute("INSERT OR REPLACE INTO stats_counters (name, value, updated_ts) "
+              "SELECT 'users', COUNT(*), CAST(strftime('%s', 'now') AS INTEGER) FROM users")
+    c.execute("INSERT OR REPLACE INTO stats_counters (name, value, updated_ts) "
+              "SELECT 'messages', COUNT(*), CAST(strftime('%s', 'now') AS INTEGER) FROM messages")
+    c.execute("DELETE FROM stats_day")
+    c.execute("DELETE FROM stats_minute")
+    c.execute("INSERT INTO stats_day (day, messages) SELECT date(ts, 'unixepoch', 'localtime') AS d, COUNT(*) "
+              "FROM messages WHERE ts IS NOT NULL GROUP BY d")
+    c.execute("INSERT INTO stats_day (day, joins) SELECT date(join_ts, 'unixepoch', 'localtime') AS d, COUNT(*) "
+              "FROM users WHERE join_ts IS NOT NULL GROUP BY d ON CONFLICT(day) DO UPDATE SET joins = excluded.joins")
+    since = "CAST(strftime('%s', 'now') AS INTEGER) - 172800"
+    c.execute(f"INSERT INTO stats_minute (minute, messages) SELECT ts / 60 * 60 AS m, COUNT(*) "
+              f"FROM messages WHERE ts >= {since} GROUP BY m")
+    c.execute(f"INSERT INTO stats_minute (minute, joins) SELECT join_ts / 60 * 60 AS m, COUNT(*) "
+              f"FROM users WHERE join_ts >= {since} GROUP BY m ON CONFLICT(minute) DO UPDATE SET joins = excluded.joins")
+
+
+def m006_outbox(c):
+    # Durable outbound queue; messages rows written for it carry the delivery state
+    _add_column(c, 'messages', 'delivery_status', 'TEXT')
+    _add_column(c, 'messages', 'telegram_message_id', 'INTEGER')
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        message_row_id INTEGER,
+        idempotency_key TEXT UNIQUE,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_ts INTEGER NOT NULL,
+        telegram_message_id INTEGER,
+        error TEXT,
+        created_ts INTEGER,
+        updated_ts INTEGER
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_ts)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_outbox_user ON outbox (user_id, created_ts)')
+
+
+def m007_invite_links(c):
+    # Pre-minted single-use channel links: pool -> assigned (to a /start user) -> used (joined)
+    c.execute('''CREATE TABLE IF NOT EXISTS invite_links (
+        invite_link TEXT PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pool',
+        user_id INTEGER,
+        created_ts INTEGER NOT NULL,
+        expire_ts INTEGER,
+        assigned_ts INTEGER,
+        used_by INTEGER,
+        used_ts INTEGER
+    ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_invite_links_pool ON invite_links (chat_id, status, expire_ts)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_invite_links_user ON invite_links (user_id, status)')
+
+
+def m008_structured_messages(c):
+    # Typed messages: kind + compact JSON payload on the row, media in attachments.
+    # Existing rows keep kind NULL until convert_legacy_messages() rewrites them in small chunks.
+    _add_column(c, 'messages', 'kind', 'TEXT')
+    _add_column(c, 'messages', 'payload', 'TEXT')
+    c.execute('''CREATE TABLE IF NOT EXISTS attachments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER NOT NULL,
+        position INTEGER NOT NULL DEFAULT 0,
+        kind TEXT NOT NULL,
+        file_id TEXT,
+        file_unique_id TEXT,
+        file_path TEXT,
+        file_size INTEGER,
+        mime_type TEXT
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_attachments_message ON attachments (message_id, position)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_attachments_unique ON attachments (file_unique_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_legacy ON messages (id) WHERE kind IS NULL')
+
+
+def m009_conversations(c):
+    # Inbox: one row per chat, kept current by a trigger on every message insert.
+    # Unread per admin = user_messages - read_messages from that admin's conversation_reads row;
+    # history before this migration (read_baseline) counts as read for everyone.
+    c.execute('''CREATE TABLE IF NOT EXISTS conversations (
+        user_id INTEGER PRIMARY KEY,
+        last_message_id INTEGER NOT NULL,
+        last_sender TEXT,
+        last_kind TEXT,
+        last_preview TEXT,
+        last_ts INTEGER,
+        user_messages INTEGER NOT NULL DEFAULT 0,
+        read_baseline INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS conversation_reads (
+        admin TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        read_messages INTEGER NOT NULL,
+        last_read_id INTEGER,
+        read_ts INTEGER,
+        PRIMARY KEY (admin, user_id)
+    ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_conversations_recent ON conversations (last_message_id)')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_messages_conversation AFTER INSERT ON messages BEGIN
+        INSERT INTO conversations (user_id, last_message_id, last_sender, last_kind, last_preview, last_ts, user_messages)
+            VALUES (NEW.user_id, NEW.id, NEW.sender, NEW.kind, substr(NEW.message, 1, {PREVIEW_LENGTH}), NEW.ts, NEW.sender = 'user')
+            ON CONFLICT(user_id) DO UPDATE SET last_message_id = excluded.last_message_id, last_sender = excluded.last_sender,
+                last_kind = excluded.last_kind, last_preview = excluded.last_preview, last_ts = excluded.last_ts,
+                user_messages = user_messages + excluded.user_messages;
+    END''')
+    # Seed from the existing rows; legacy (kind NULL) text may hold file URLs, so no preview for those
+    c.execute(f"INSERT OR REPLACE INTO conversations (user_id, last_message_id, last_sender, last_kind, last_preview, last_ts, "
+              f"user_messages, read_baseline) "
+              f"SELECT m.user_id, m.id, m.sender, m.kind, CASE WHEN m.kind IS NULL THEN NULL ELSE substr(m.message, 1, {PREVIEW_LENGTH}) END, "
+              f"m.ts, counts.n, counts.n "
+              f"FROM (SELECT user_id, MAX(id) AS last_id, SUM(sender = 'user') AS n FROM messages GROUP BY user_id) counts "
+              f"JOIN messages m ON m.id = counts.last_id")
+
+
+def m010_message_search(c):
+    # Full-text index over messages.message (external content: the text is not stored twice).
+    # Legacy rows (kind NULL) hold raw file URLs and are indexed once converted. Rows that existed
+    # before this migration are indexed by backfill_search(); search_backfill holds the id range
+    # still to do, and the triggers leave rows in that range alone so nothing is indexed twice.
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+              "message, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+    c.execute('''CREATE TABLE IF NOT EXISTS search_backfill (
+        next_id INTEGER NOT NULL,
+        end_id INTEGER NOT NULL
+    )''')
+    pending = "NOT EXISTS (SELECT 1 FROM search_backfill WHERE {row}.id BETWEEN next_id AND end_id)"
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert AFTER INSERT ON messages
+        WHEN NEW.kind IS NOT NULL BEGIN
+        INSERT INTO messages_fts (rowid, message) VALUES (NEW.id, NEW.message);
+    END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update AFTER UPDATE OF message, kind ON messages
+        WHEN {pending.format(row='NEW')} BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, message) SELECT 'delete', OLD.id, OLD.message WHERE OLD.kind IS NOT NULL;
+        INSERT INTO messages_fts (rowid, message) SELECT NEW.id, NEW.message WHERE NEW.kind IS NOT NULL;
+    END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete AFTER DELETE ON messages
+        WHEN OLD.kind IS NOT NULL AND {pending.format(row='OLD')} BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+    END''')
+    c.execute('INSERT INTO search_backfill (next_id, end_id) SELECT MIN(id), MAX(id) FROM messages HAVING COUNT(*) > 0')
+
+
+def m011_user_filters(c):
+    # /dashboard-users filters and sort orders; the name indexes are NOCASE so prefix LIKE can use them
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_label ON users (label, join_ts)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_name ON users (full_name COLLATE NOCASE)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_invite_link ON users (invite_link)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_activity ON users (COALESCE(last_activity, 0))')
+
+
+def m012_user_labels(c):
+    # Labels as tags: many per user. labels.users is kept by triggers for the label counts.
+    # users.label is copied over and no longer read or written.
+    c.execute('''CREATE TABLE IF NOT EXISTS labels (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        users INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS user_labels (
+        user_id INTEGER NOT NULL,
+        label_id INTEGER NOT NULL,
+        created_ts INTEGER,
+        PRIMARY KEY (user_id, label_id)
+    ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_user_labels_label ON user_labels (label_id, user_id)')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_labels_insert AFTER INSERT ON user_labels BEGIN
+        UPDATE labels SET users = users + 1 WHERE id = NEW.label_id;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_labels_delete AFTER DELETE ON user_labels BEGIN
+        UPDATE labels SET users = users - 1 WHERE id = OLD.label_id;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_delete_labels AFTER DELETE ON users BEGIN
+        DELETE FROM user_labels WHERE user_id = OLD.user_id;
+    END''')
+    c.execute("INSERT OR IGNORE INTO labels (name) SELECT DISTINCT trim(label) FROM users WHERE trim(label) != ''")
+    c.execute("INSERT OR IGNORE INTO user_labels (user_id, label_id, created_ts) "
+              "SELECT u.user_id, l.id, CAST(strftime('%s', 'now') AS INTEGER) FROM users u JOIN labels l ON l.name = trim(u.label)")
+    c.execute('DROP INDEX IF EXISTS idx_users_label')
+
+
+def m013_imports(c):
+    # Bulk member imports; position = source rows already committed, so a re-sent stream resumes after them
+    c.execute('''CREATE TABLE IF NOT EXISTS imports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT,
+        format TEXT NOT NULL,
+        labels TEXT,
+        status TEXT NOT NULL DEFAULT 'running',
+        position INTEGER NOT NULL DEFAULT 0,
+        imported INTEGER NOT NULL DEFAULT 0,
+        invalid INTEGER NOT NULL DEFAULT 0,
+        errors TEXT,
+        created_ts INTEGER,
+        updated_ts INTEGER
+    )''')
+
+
+def m014_page_order(c):
+    # Label pages in join order straight off an index: user_labels carries a copy of users.join_ts,
+    # written with the row and kept in step by the trigger (join_ts is not normally changed)
+    c.execute('ALTER TABLE user_labels ADD COLUMN join_ts INTEGER')
+    c.execute('UPDATE user_labels SET join_ts = (SELECT join_ts FROM users WHERE users.user_id = user_labels.user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_user_labels_join ON user_labels (label_id, join_ts, user_id)')
+    c.execute('DROP INDEX IF EXISTS idx_user_labels_label')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_join_ts AFTER UPDATE OF join_ts ON users
+        WHEN NEW.join_ts IS NOT OLD.join_ts BEGIN
+        UPDATE user_labels SET join_ts = NEW.join_ts WHERE user_id = NEW.user_id;
+    END''')
+    # Users from one invite link, newest first, without sorting them all
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_invite_join ON users (invite_link, join_ts)')
+    c.execute('DROP INDEX IF EXISTS idx_users_invite_link')
+
+
+def m015_stats_default_ts(c):
+    # Rows inserted without ts / join_ts (older code paths, other tools writing the file) count as
+    # happening now; a NULL day would otherwise fail the insert itself
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    c.execute('DROP TRIGGER IF EXISTS trg_users_insert')
+    c.execute(f'''CREATE TRIGGER trg_users_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + 1, updated_ts = {now} WHERE name = 'users';
+        INSERT INTO stats_minute (minute, joins) VALUES (COALESCE(NEW.join_ts, {now}) / 60 * 60, 1)
+            ON CONFLICT(minute) DO UPDATE SET joins = joins + 1;
+        INSERT INTO stats_day (day, joins) VALUES (date(COALESCE(NEW.join_ts, {now}), 'unixepoch', 'localtime'), 1)
+            ON CONFLICT(day) DO UPDATE SET joins = joins + 1;
+    END''')
+    c.execute('DROP TRIGGER IF EXISTS trg_messages_insert')
+    c.execute(f'''CREATE TRIGGER trg_messages_insert AFTER INSERT ON messages BEGIN
+        UPDATE stats_counters SET value = value + 1, updated_ts = {now} WHERE name = 'messages';
+        INSERT INTO stats_minute (minute, messages) VALUES (COALESCE(NEW.ts, {now}) / 60 * 60, 1)
+            ON CONFLICT(minute) DO UPDATE SET messages = messages + 1;
+        INSERT INTO stats_day (day, messages) VALUES (date(COALESCE(NEW.ts, {now}), 'unixepoch', 'localtime'), 1)
+            ON CONFLICT(day) DO UPDATE SET messages = messages + 1;
+        UPDATE users SET last_activity = COALESCE(NEW.ts, {now}) WHERE NEW.sender = 'user' AND user_id = NEW.user_id;
+    END''')
+
+
+def m016_profile_photos(c):
+    # Profile photos are served through /media/photo/<file_unique_id>: the row keeps the Telegram ids,
+    # never a download URL (those carry the bot token and expire)
+    _add_column(c, 'users', 'photo_file_id', 'TEXT')
+    _add_column(c, 'users', 'photo_unique_id', 'TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_photo ON users (photo_unique_id) WHERE photo_unique_id IS NOT NULL')
+    # Refetched by ProfileCache the next time each user writes
+    c.execute('UPDATE users SET photo_url = NULL WHERE photo_url IS NOT NULL')
+
+
+def m017_conversation_previews(c):
+    # Chats whose last message was converted before convert_legacy_messages kept conversations in step
+    c.execute(f"UPDATE conversations SET last_kind = m.kind, last_preview = substr(m.message, 1, {PREVIEW_LENGTH}) "
+              f"FROM messages m WHERE m.id = conversations.last_message_id AND conversations.last_kind IS NULL "
+              f"AND m.kind IS NOT NULL")
+
+
+def m018_attachment_paths(c):
+    # Album items used to be saved with get_file's full download URL, bot token included; keep only the path
+    prefix = 'https://api.telegram.org/file/bot'
+    c.execute(f"UPDATE attachments SET file_path = substr(file_path, {len(prefix) + 1} + instr(substr(file_path, {len(prefix) + 1}), '/')) "
+              f"WHERE file_path LIKE '{prefix}%'")
+
+
+MIGRATIONS = [
+    m001_base_tables,
+    m002_user_columns,
+    m003_integer_timestamps,
+    m004_indexes,
+    m005_stats_aggregates,
+    m006_outbox,
+    m007_invite_links,
+    m008_structured_messages,
+    m009_conversations,
+    m010_message_search,
+    m011_user_filters,
+    m012_user_labels,
+    m013_imports,
+    m014_page_order,
+    m015_stats_default_ts,
+    m016_profile_photos,
+    m017_conversation_previews,
+    m018_attachment_paths,
+]
+
+
+def migrate(conn):
+    """Apply every migration newer than the database's user_version."""
+    applied = []
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return applied
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-read inside the write lock: another process may have just migrated
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            if current >= version:
+                conn.rollback()
+                continue
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version}')
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        applied.append(migration.__name__)
+    if applied:
+        print(f"Applied migrations: {', '.join(applied)}")
+    return applied
+
+
+LEGACY_LABELS = {
+    '[image]': 'image', '[video]': 'video', '[voice]': 'voice', '[audio]': 'audio', '[gif]': 'gif',
+    '[images]': 'image', '[videos]': 'video', '[voices]': 'voice', '[gifs]': 'gif',
+}
+_BOT_FILE_URL = re.compile(r'^https://api\.telegram\.org/file/bot[^/]+/(.+)$')
+
+
+def parse_legacy_message(message):
+    """Split a pre-m008 "[image]url" or "[images]\\nurl\\nurl" string into (kind, text, attachments).
+
+    Bot API file URLs are reduced to their file_path so the token is not stored.
+    """
+    message = message or ''
+    first_line = message.split('\n', 1)[0]
+    if first_line in LEGACY_LABELS and first_line.endswith('s]'):
+        kind = LEGACY_LABELS[first_line]
+        urls = [u.strip() for u in message.split('\n')[1:] if u.strip()]
+    else:
+        label = next((lbl for lbl in LEGACY_LABELS if not lbl.endswith('s]') and message.startswith(lbl)), None)
+        if label is None:
+            return 'text', message, []
+        kind = LEGACY_LABELS[label]
+        urls = [message[len(label):].strip()]
+    attachments = []
+    for url in urls:
+        match = _BOT_FILE_URL.match(url)
+        attachments.append({'kind': kind, 'file_path': match.group(1) if match else url})
+    return ('album' if len(attachments) > 1 else kind), '', attachments
+
+
+def convert_legacy_messages(conn, limit=500):
+    """Convert up to `limit` rows saved before m008; returns how many were converted (0 once done).
+
+    Each call is one short transaction, so readers and the message writer keep
+    running while a large history is converted.
+    """
+    rows = conn.execute('SELECT id, message FROM messages WHERE kind IS NULL ORDER BY id LIMIT ?', (limit,)).fetchall()
+    if not rows:
+        return 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for message_id, message in rows:
+            kind, text, attachments = parse_legacy_message(message)
+            conn.execute('UPDATE messages SET kind = ?, message = ? WHERE id = ? AND kind IS NULL', (kind, text, message_id))
+            # m009 seeded legacy last messages without kind or preview
+            conn.execute('UPDATE conversations SET last_kind = ?, last_preview = ? WHERE last_message_id = ?',
+                         (kind, text[:PREVIEW_LENGTH], message_id))
+            conn.executemany('INSERT INTO attachments (message_id, position, kind, file_path) VALUES (?, ?, ?, ?)',
+                             [(message_id, i, a['kind'], a['file_path']) for i, a in enumerate(attachments)])
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return len(rows)
+
+
+def backfill_search(conn, limit=2000):
+    """Index up to `limit` more pre-m010 rows; returns how many ids were covered (0 once done)."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        state = conn.execute('SELECT next_id, end_id FROM search_backfill').fetchone()
+        if state is None:
+            conn.rollback()
+            return 0
+        next_id, end_id = state
+        ids = [r[0] for r in conn.execute('SELECT id FROM messages WHERE id BETWEEN ? AND ? ORDER BY id LIMIT ?',
+                                          (next_id, end_id, limit))]
+        upto = ids[-1] if ids and len(ids) == limit else end_id
+        conn.execute('INSERT INTO messages_fts (rowid, message) SELECT id, message FROM messages '
+                     'WHERE id BETWEEN ? AND ? AND kind IS NOT NULL', (next_id, upto))
+        if upto >= end_id:
+            conn.execute('DELETE FROM search_backfill')
+        else:
+            conn.execute('UPDATE search_backfill SET next_id = ?', (upto + 1,))
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return len(ids)
+
+
+# Hot queries with representative parameters; each must be answered from an index.
+# db.py adds the get_users_page variants, built by the same code that runs them.
+HOT_QUERIES = {
+    'get_active_users': ('SELECT COUNT(*) FROM users WHERE last_activity >= ?', (0,)),
+    'get_dashboard_stats': ("SELECT name, value, updated_ts FROM stats_counters WHERE name IN ('users', 'messages')", ()),
+    'get_dashboard_stats (today)': ('SELECT joins FROM stats_day WHERE day = ?', ('2024-01-01',)),
+    'get_stats_series': ('SELECT minute, messages, joins FROM stats_minute WHERE minute >= ? ORDER BY minute', (0,)),
+    'user labels': ('SELECT l.name FROM user_labels ul JOIN labels l ON l.id = ul.label_id WHERE ul.user_id = ?', (1,)),
+    'label count': ('SELECT users FROM labels WHERE name = ?', ('vip',)),
+    'broadcast to label': ("SELECT user_id FROM user_labels WHERE label_id = (SELECT id FROM labels WHERE name = ?)", ('vip',)),
+    'outbox due': ("SELECT id FROM outbox WHERE status = 'queued' AND next_attempt_ts <= ? ORDER BY next_attempt_ts LIMIT ?", (0, 100)),
+    'invite link (reuse)': ("SELECT invite_link FROM invite_links WHERE user_id = ? AND status = 'assigned' "
+                            "AND chat_id = ? AND expire_ts > ? LIMIT 1", (1, 1, 0)),
+    'invite link (claim)': ("SELECT invite_link FROM invite_links WHERE chat_id = ? AND status = 'pool' AND expire_ts > ? "
+                            "ORDER BY expire_ts LIMIT 1", (1, 0)),
+    'chat history (latest)': ('SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?', (1, 101)),
+    'chat history (before_id)': ('SELECT id FROM messages WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?', (1, 1000, 101)),
+    'chat history (after_id)': ('SELECT id FROM messages WHERE user_id = ? AND id > ? ORDER BY id ASC LIMIT ?', (1, 1000, 101)),
+    'chat history attachments': ('SELECT message_id, kind FROM attachments WHERE message_id IN (?, ?) ORDER BY message_id, position', (1, 2)),
+    'media by file_unique_id': ('SELECT id, file_id FROM attachments WHERE file_unique_id = ? ORDER BY id DESC LIMIT 1', ('x',)),
+    'legacy messages': ('SELECT id, message FROM messages WHERE kind IS NULL ORDER BY id LIMIT ?', (500,)),
+    'conversations': ('SELECT c.user_id, r.read_messages, u.full_name FROM conversations c '
+                      'LEFT JOIN conversation_reads r ON r.admin = ? AND r.user_id = c.user_id '
+                      'LEFT JOIN users u ON u.user_id = c.user_id '
+                      'WHERE c.last_message_id < ? ORDER BY c.last_message_id DESC LIMIT ?', ('default', 1 << 62, 50)),
+    'search (recent)': ('SELECT m.id FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid '
+                        'WHERE messages_fts MATCH ? AND messages_fts.rowid < ? ORDER BY messages_fts.rowid DESC LIMIT ?',
+                        ('refund', 1 << 62, 20)),
+    'export messages (date range)': ('SELECT id FROM messages WHERE ts < ? AND (ts, user_id, id) > (?, ?, ?) '
+                                     'ORDER BY ts, user_id, id LIMIT ?', (2000000000, 0, 0, 0, 1000)),
+    'export users': ('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (0, 1000)),
+    'profile photo': ('SELECT photo_file_id FROM users WHERE photo_unique_id = ? LIMIT 1', ('x',)),
+    'get_last_activity': ('SELECT last_activity FROM users WHERE user_id = ?', (1,)),
+    'get_last_activities': ('SELECT user_id, last_activity FROM users WHERE user_id IN (?, ?) AND last_activity IS NOT NULL', (1, 2)),
+}
+
+
+def check_query_plans(conn):
+    """Return {query name: plan} for every hot query that does not use an index."""
+    failures = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        # A full table scan or a temp sort means the query grows with the table (FTS5 lookups are index scans)
+        indexed = lambda step: 'USING' in step or 'VIRTUAL TABLE INDEX' in step
+        full_scan = any(step.startswith('SCAN') and not indexed(step) for step in plan)
+        temp_sort = any('TEMP B-TREE FOR ORDER BY' in step for step in plan)
+        if full_scan or temp_sort or not any(indexed(step) for step in plan):
+            failures[name] = plan
+    return failures
+
+
+if __name__ == '__main__':
+    import db
+    # Run as a script this file is __main__; the registry db.py extended lives on the imported module
+    import migrations
+    db.init_db()
+    if '--convert-messages' in sys.argv:
+        total = 0
+        while True:
+            count = db.convert_legacy_messages()
+            if not count:
+                break
+            total += count
+        print(f"Converted {total} legacy messages")
+    if '--backfill-search' in sys.argv:
+        total = 0
+        while True:
+            count = db.backfill_search()
+            if not count:
+                break
+            total += count
+        print(f"Indexed {total} messages for search")
+    with db.connection() as conn:
+        failures = migrations.check_query_plans(conn)
+    for name, plan in failures.items():
+        print(f"{name}: no index used -> {plan}")
+    if failures:
+        sys.exit(1)
+    print(f"All {len(migrations.HOT_QUERIES)} hot queries use an index.")
@@ -0,0 +1,178 @@
+import asyncio
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from broadcast import GLOBAL_RATE
+from db import connection, from_ts, transaction
+from ratelimit import PerChatLimiter, TokenBucket
+from runtime import run_blocking
+
+WORKERS = 4
+CLAIM_BATCH = 100
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 2
+BACKOFF_MAX = 300
+
+
+class Outbox:
+    """Durable outbound queue for admin messages.
+
+    enqueue() stores the message (and its chat-history row) in SQLite before
+    anything is sent. Workers drain due rows at the allowed rate, retry 429/5xx
+    with exponential backoff (honouring retry_after) and record the Telegram
+    message id, so the dashboard shows real delivery state: queued/sent/failed.
+    """
+
+    def __init__(self, bot, bucket=None, workers=WORKERS, on_update=None):
+        self.bot = bot
+        self.bucket = bucket or TokenBucket(GLOBAL_RATE)
+        self.per_chat = PerChatLimiter(1.0)
+        self.workers = workers
+        self.on_update = on_update
+        self.loop = None
+        self._wakeup = None
+
+    def enqueue(self, user_id, text, idempotency_key=None):
+        """Queue `text` for `user_id`. Returns (outbox row dict, created).
+
+        Only a repeated `idempotency_key` (one per compose action) counts as a
+        duplicate; without a key every call sends, even the same text twice.
+        """
+        now = int(time.time())
+        with transaction() as conn:
+            if idempotency_key:
+                row = conn.execute('SELECT id FROM outbox WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+                if row is not None:
+                    return self.get(row[0]), False
+            c = conn.cursor()
+            c.execute("INSERT INTO messages (user_id, sender, message, timestamp, ts, kind, delivery_status) "
+                      "VALUES (?, 'admin', ?, ?, ?, 'text', 'queued')", (user_id, text, from_ts(now), now))
+            c.execute("INSERT INTO outbox (user_id, text, message_row_id, idempotency_key, status, next_attempt_ts, "
+                      "created_ts, updated_ts) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                      (user_id, text, c.lastrowid, idempotency_key, now, now, now))
+            outbox_id = c.lastrowid
+        self._wake()
+        return self.get(outbox_id), True
+
+    def get(self, outbox_id):
+        with connection() as conn:
+            row = conn.execute('SELECT id, user_id, status, attempts, telegram_message_id, error, created_ts, updated_ts, message_row_id '
+                               'FROM outbox WHERE id = ?', (outbox_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'outbox_id': row[0],
+            'user_id': row[1],
+            'message_id': row[8],
+            'status': row[2],
+            'attempts': row[3],
+            'telegram_message_id': row[4],
+            'error': row[5],
+            'created_at': from_ts(row[6]),
+            'updated_at': from_ts(row[7])
+        }
+
+    # --- Workers ---
+
+    def _wake(self):
+        if self.loop is not None and self._wakeup is not None:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await run_blocking(self._requeue_stale)
+        queue = asyncio.Queue(maxsize=CLAIM_BATCH)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        try:
+            while True:
+                claimed, next_due = await run_blocking(self._claim, CLAIM_BATCH - queue.qsize())
+                for item in claimed:
+                    await queue.put(item)
+                if claimed:
+                    continue
+                self._wakeup.clear()
+                timeout = 5 if next_due is None else min(5, max(next_due - time.time(), 0.05))
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for w in workers:
+                w.cancel()
+
+    @staticmethod
+    def _requeue_stale():
+        with connection() as conn:
+            # Rows a previous process was sending when it died go back in the queue
+            conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'")
+
+    def _claim(self, limit):
+        if limit <= 0:
+            return [], None
+        now = int(time.time())
+        with transaction() as conn:
+            rows = conn.execute("SELECT id, user_id, text, attempts, message_row_id FROM outbox "
+                                "WHERE status = 'queued' AND next_attempt_ts <= ? ORDER BY next_attempt_ts LIMIT ?",
+                                (now, limit)).fetchall()
+            if rows:
+                conn.executemany("UPDATE outbox SET status = 'sending', updated_ts = ? WHERE id = ?",
+                                 [(now, r[0]) for r in rows])
+                return rows, None
+            nxt = conn.execute("SELECT MIN(next_attempt_ts) FROM outbox WHERE status = 'queued'").fetchone()[0]
+        return [], nxt
+
+    async def _worker(self, queue):
+        while True:
+            outbox_id, user_id, text, attempts, message_row_id = await queue.get()
+            try:
+                await self._deliver(outbox_id, user_id, text, attempts + 1, message_row_id)
+            except Exception as e:
+                print(f"Outbox worker error on {outbox_id}: {e}")
+                await self._retry(outbox_id, message_row_id, attempts + 1, str(e), BACKOFF_MAX)
+
+    async def _deliver(self, outbox_id, user_id, text, attempt, message_row_id):
+        await self.bucket.acquire()
+        await self.per_chat.acquire(user_id)
+        try:
+            sent = await self.bot.send_message(chat_id=user_id, text=text)
+        except RetryAfter as e:
+            retry_after = float(e.retry_after)
+            self.bucket.block(retry_after)
+            self.per_chat.block(user_id, retry_after)
+            await self._retry(outbox_id, message_row_id, attempt, str(e), retry_after)
+        except (Forbidden, BadRequest) as e:
+            await self._finish(outbox_id, message_row_id, 'failed', attempt, str(e))
+        except NetworkError as e:
+            # Timeouts and 5xx from Telegram
+            await self._retry(outbox_id, message_row_id, attempt, str(e), min(BACKOFF_BASE ** attempt, BACKOFF_MAX))
+        else:
+            await self._finish(outbox_id, message_row_id, 'sent', attempt, None, telegram_message_id=sent.message_id)
+
+    async def _retry(self, outbox_id, message_row_id, attempt, error, delay):
+        if attempt >= MAX_ATTEMPTS:
+            await self._finish(outbox_id, message_row_id, 'failed', attempt, error)
+        else:
+            await self._finish(outbox_id, message_row_id, 'queued', attempt, error, retry_in=delay)
+
+    async def _finish(self, outbox_id, message_row_id, status, attempts, error, telegram_message_id=None, retry_in=0):
+        row = await run_blocking(self._record, outbox_id, message_row_id, status, attempts, error,
+                                 telegram_message_id, retry_in)
+        self._wake()
+        if self.on_update is not None:
+            try:
+                self.on_update(row)
+            except Exception as e:
+                print(f"Outbox update callback failed: {e}")
+
+    def _record(self, outbox_id, message_row_id, status, attempts, error, telegram_message_id, retry_in):
+        now = int(time.time())
+        with transaction() as conn:
+            conn.execute('UPDATE outbox SET status = ?, attempts = ?, error = ?, telegram_message_id = ?, '
+                         'next_attempt_ts = ?, updated_ts = ? WHERE id = ?',
+                         (status, attempts, error, telegram_message_id, now + int(retry_in + 0.999), now, outbox_id))
+            if message_row_id is not None:
+                conn.execute('UPDATE messages SET delivery_status = ?, telegram_message_id = ? WHERE id = ?',
+                             (status, telegram_message_id, message_row_id))
+        return self.get(outbox_id)
@@ -0,0 +1,126 @@
+import atexit
+import threading
+import time
+
+from db import connection, transaction
+
+ONLINE_SECONDS = 5 * 60
+SWEEP_INTERVAL = 15
+PERSIST_INTERVAL = 30
+PRELOAD_SECONDS = 24 * 3600
+
+
+class PresenceTracker:
+    """In-memory last-seen times, fed by incoming user messages.
+
+    Online/last-activity lookups never touch SQLite. Updated entries are written
+    back to users.last_activity in one batch every PERSIST_INTERVAL seconds, and
+    `on_change(user_id, is_online, last_seen)` fires when a user goes online/offline.
+    """
+
+    def __init__(self, online_seconds=ONLINE_SECONDS, on_change=None):
+        self.online_seconds = online_seconds
+        self.on_change = on_change
+        self.last_seen = {}  # user_id -> epoch seconds
+        self.online = set()
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self._thread = None
+
+    def load(self):
+        """Seed from the database so a restart does not show everyone offline."""
+        since = int(time.time()) - PRELOAD_SECONDS
+        with connection() as conn:
+            rows = conn.execute('SELECT user_id, last_activity FROM users WHERE last_activity >= ?', (since,)).fetchall()
+        cutoff = time.time() - self.online_seconds
+        with self.lock:
+            for user_id, ts in rows:
+                if ts > self.last_seen.get(user_id, 0):
+                    self.last_seen[user_id] = ts
+                if ts >= cutoff:
+                    self.online.add(user_id)
+
+    def touch(self, user_id, ts=None):
+        ts = int(ts if ts is not None else time.time())
+        with self.lock:
+            if ts <= self.last_seen.get(user_id, 0):
+                return
+            self.last_seen[user_id] = ts
+            self.dirty[user_id] = ts
+            came_online = user_id not in self.online
+            self.online.add(user_id)
+        if came_online:
+            self._notify(user_id, True, ts)
+
+    def get_last_seen(self, user_id):
+        return self.last_seen.get(user_id)
+
+    def is_online(self, user_id):
+        ts = self.last_seen.get(user_id)
+        return ts is not None and ts >= time.time() - self.online_seconds
+
+    def bulk(self, user_ids):
+        cutoff = time.time() - self.online_seconds
+        result = {}
+        for user_id in user_ids:
+            ts = self.last_seen.get(user_id)
+            result[user_id] = (ts is not None and ts >= cutoff, ts)
+        return result
+
+    def online_users(self):
+        with self.lock:
+            return list(self.online)
+
+    def sweep(self):
+        # Only currently-online users are checked, not every user ever seen
+        cutoff = time.time() - self.online_seconds
+        with self.lock:
+            expired = [u for u in self.online if self.last_seen.get(u, 0) < cutoff]
+            self.online.difference_update(expired)
+        for user_id in expired:
+            self._notify(user_id, False, self.last_seen.get(user_id))
+
+    def persist(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return 0
+        try:
+            with transaction() as conn:
+                conn.executemany('UPDATE users SET last_activity = ? WHERE user_id = ? '
+                                 'AND (last_activity IS NULL OR last_activity < ?)',
+                                 [(ts, user_id, ts) for user_id, ts in dirty.items()])
+        except Exception as e:
+            print(f"Could not persist presence: {e}")
+            with self.lock:
+                for user_id, ts in dirty.items():
+                    if ts > self.dirty.get(user_id, 0):
+                        self.dirty[user_id] = ts
+            return 0
+        return len(dirty)
+
+    def _notify(self, user_id, is_online, last_seen):
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(user_id, is_online, last_seen)
+        except Exception as e:
+            print(f"Presence callback failed for {user_id}: {e}")
+
+    def start(self):
+        if self._thread is not None:
+            return self._thread
+        self.load()
+        self._thread = threading.Thread(target=self._run, name='presence', daemon=True)
+        self._thread.start()
+        atexit.register(self.persist)
+        return self._thread
+
+    def _run(self):
+        last_persist = time.time()
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            self.sweep()
+            if time.time() - last_persist >= PERSIST_INTERVAL:
+                self.persist()
+                last_persist = time.time()
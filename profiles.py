@@ -0,0 +1,79 @@
+import asyncio
+import datetime
+import time
+from collections import OrderedDict
+
+from db import add_user, get_user, set_user_photo
+from runtime import run_blocking
+
+MAX_PROFILES = 10000
+PHOTO_TTL = 6 * 3600  # re-check a user's profile photo at most this often
+REFRESH_RETRY = 300  # after a failed lookup
+
+
+class ProfileCache:
+    """LRU cache of what users.* holds for each user, so inbound messages only hit
+    the database when the name/username actually changed and never wait on the
+    Bot API: photo lookups run as background tasks, at most one per user per TTL.
+    """
+
+    def __init__(self, max_size=MAX_PROFILES, photo_ttl=PHOTO_TTL):
+        self.max_size = max_size
+        self.photo_ttl = photo_ttl
+        self.entries = OrderedDict()  # user_id -> {'full_name', 'username', 'photo_id', 'photo_checked'}
+        self._refreshing = {}  # user_id -> asyncio.Task
+
+    async def _get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            self.entries.move_to_end(user_id)
+            return entry
+        row = await run_blocking(get_user, user_id)
+        if row is None:
+            return None
+        entry = {'full_name': row[1], 'username': row[2], 'photo_id': row[5], 'photo_checked': 0}
+        self._put(user_id, entry)
+        return entry
+
+    def peek(self, user_id):
+        """Cached entry for user_id without touching the database or the LRU order, or None."""
+        return self.entries.get(user_id)
+
+    def _put(self, user_id, entry):
+        self.entries[user_id] = entry
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def observe(self, bot, user):
+        """Record a Telegram user seen in an update; writes only if something changed."""
+        full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+        username = user.username or ''
+        entry = await self._get(user.id)
+        if entry is None or entry['full_name'] != full_name or entry['username'] != username:
+            join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            await run_blocking(add_user, user.id, full_name, username, join_date)
+            if entry is None:
+                entry = {'full_name': full_name, 'username': username, 'photo_id': None, 'photo_checked': 0}
+                self._put(user.id, entry)
+            else:
+                entry['full_name'], entry['username'] = full_name, username
+        if time.time() - entry['photo_checked'] >= self.photo_ttl and user.id not in self._refreshing:
+            task = asyncio.get_running_loop().create_task(self._refresh_photo(bot, user.id, entry))
+            self._refreshing[user.id] = task
+            task.add_done_callback(lambda _t, uid=user.id: self._refreshing.pop(uid, None))
+        return entry
+
+    async def _refresh_photo(self, bot, user_id, entry):
+        try:
+            photos = await bot.get_user_profile_photos(user_id, limit=1)
+            photo = photos.photos[0][0] if photos.total_count else None
+            # Only the ids are stored; /media/photo resolves the file when someone views it
+            photo_id = photo.file_unique_id if photo else None
+            if photo_id != entry['photo_id']:
+                await run_blocking(set_user_photo, user_id, photo.file_id if photo else None, photo_id)
+                entry['photo_id'] = photo_id
+            entry['photo_checked'] = time.time()
+        except Exception as e:
+            print(f"Could not fetch profile photo for user {user_id}: {e}")
+            entry['photo_checked'] = time.time() - self.photo_ttl + REFRESH_RETRY
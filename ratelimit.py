@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        # Telegram told us to back off (429 retry_after): nobody sends until it expires
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class PerChatLimiter:
+    """Keeps at least `interval` seconds between two sends to the same chat."""
+
+    def __init__(self, interval=1.0, max_chats=100000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self.next_allowed = {}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        wait = self.next_allowed.get(chat_id, 0) - now
+        if wait > 0:
+            await asyncio.sleep(wait)
+            now = time.monotonic()
+        self.next_allowed[chat_id] = now + self.interval
+        if len(self.next_allowed) > self.max_chats:
+            self._prune(now)
+
+    def block(self, chat_id, seconds):
+        self.next_allowed[chat_id] = max(self.next_allowed.get(chat_id, 0), time.monotonic() + seconds)
+
+    def _prune(self, now):
+        for chat_id in [c for c, t in self.next_allowed.items() if t <= now]:
+            del self.next_allowed[chat_id]
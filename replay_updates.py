@@ -0,0 +1,117 @@
+"""Replay recorded Telegram updates through the update dispatcher and report updates/s.
+
+    python replay_updates.py [updates.ndjson] [--workers 1,8,32] [--latency-ms 50] [--parse]
+    python replay_updates.py updates.ndjson --url http://127.0.0.1:5001/telegram/webhook --secret <WEBHOOK_SECRET>
+
+The file holds one update JSON object per line (or a JSON array). Without a file,
+synthetic private-chat messages from 200 users are generated. In-process runs
+replace the bot handlers with a sleep of --latency-ms (the Bot API / database
+round-trips a real handler waits on) and check that each user's updates were
+handled in order. --url posts the updates to a running webhook instead.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from dispatcher import UpdateDispatcher, update_key
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def synthetic_updates(count, users=200):
+    updates = []
+    for i in range(count):
+        user_id = 1000 + random.randrange(users)
+        updates.append({
+            'update_id': i + 1,
+            'message': {
+                'message_id': i + 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private', 'first_name': 'User'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+                'text': f'message {i}'
+            }
+        })
+    return updates
+
+
+async def replay(updates, workers, latency, parse):
+    seen = {}
+    out_of_order = 0
+
+    async def handler(data):
+        nonlocal out_of_order
+        if parse:
+            from telegram import Update
+            Update.de_json(data, None)
+        key = update_key(data)
+        if data['update_id'] < seen.get(key, 0):
+            out_of_order += 1
+        seen[key] = data['update_id']
+        await asyncio.sleep(latency)
+
+    dispatcher = UpdateDispatcher(handler, workers=workers, max_queue=len(updates))
+    dispatcher.start()
+    start = time.perf_counter()
+    for data in updates:
+        dispatcher.put_nowait(data)
+    await dispatcher.join()
+    elapsed = time.perf_counter() - start
+    await dispatcher.stop()
+    return elapsed, out_of_order
+
+
+def post_all(updates, url, secret, concurrency):
+    def post(data):
+        req = urllib.request.Request(url, data=json.dumps(data).encode(), method='POST', headers={
+            'Content-Type': 'application/json',
+            'X-Telegram-Bot-Api-Secret-Token': secret
+        })
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                return resp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        statuses = list(pool.map(post, updates))
+    elapsed = time.perf_counter() - start
+    return elapsed, {s: statuses.count(s) for s in set(statuses)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('file', nargs='?')
+    parser.add_argument('--count', type=int, default=2000, help='synthetic updates when no file is given')
+    parser.add_argument('--workers', default='1,8,32')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--parse', action='store_true', help='include Update.de_json in the handler')
+    parser.add_argument('--url')
+    parser.add_argument('--secret', default='')
+    parser.add_argument('--concurrency', type=int, default=40)
+    args = parser.parse_args()
+
+    updates = load_updates(args.file) if args.file else synthetic_updates(args.count)
+    print(f"{len(updates)} updates from {len({update_key(u) for u in updates})} users")
+    if args.url:
+        elapsed, statuses = post_all(updates, args.url, args.secret, args.concurrency)
+        print(f"{'webhook':<12} {len(updates) / elapsed:>10.0f} updates/s  responses {statuses}")
+        return
+    for workers in (int(w) for w in args.workers.split(',')):
+        elapsed, out_of_order = asyncio.run(replay(updates, workers, args.latency_ms / 1000, args.parse))
+        print(f"{workers:>3} workers  {len(updates) / elapsed:>10.0f} updates/s  out of order: {out_of_order}")
+
+
+if __name__ == '__main__':
+    main()
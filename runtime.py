@@ -0,0 +1,45 @@
+"""The boundaries of the single-process runtime.
+
+One asyncio loop (the main thread) hosts the Telegram clients and the
+background engines. Flask/Socket.IO requests run on server threads and reach
+that loop only through submit(); async code reaches blocking SQLite work only
+through run_blocking(), which uses a small dedicated thread pool.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+DB_THREADS = 4
+
+# Created at import, before any client: Pyrogram binds to the current loop when constructed
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+_db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='db')
+
+
+def run(main):
+    """Run the `main` coroutine on the runtime loop (blocks the calling thread)."""
+    try:
+        loop.run_until_complete(main)
+    finally:
+        _db_executor.shutdown(wait=True)
+
+
+def submit(coro):
+    """Schedule `coro` on the runtime loop from another thread; returns a concurrent.futures.Future."""
+    if not loop.is_running():
+        coro.close()
+        raise RuntimeError('Telegram runtime is not running')
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+
+def call(fn, *args, timeout=5):
+    """Run a plain function on the runtime loop from another thread and return its result."""
+    async def _call():
+        return fn(*args)
+    return submit(_call()).result(timeout)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run blocking (database) work off the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, partial(fn, *args, **kwargs))
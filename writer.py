@@ -0,0 +1,182 @@
+import asyncio
+import atexit
+import queue
+import threading
+import time
+
+from db import from_ts, save_messages, to_ts
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.05  # seconds a record may wait for more to batch with
+MAX_QUEUE = 20000
+
+_STOP = object()
+
+
+class MessageWriter:
+    """Write-behind queue for the messages table.
+
+    Handlers enqueue and return immediately; one writer thread commits whatever
+    has accumulated in a single executemany transaction once BATCH_SIZE records
+    are waiting or FLUSH_INTERVAL has passed. The queue is bounded: when the
+    database falls behind, producers wait instead of growing memory.
+    on_saved([(message_id, record), ...]) is called from the writer thread
+    after each committed batch.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_queue=MAX_QUEUE, on_saved=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_saved = on_saved
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.cond = threading.Condition()
+        self.enqueued = 0
+        self.flushed = 0
+        self.failed = 0
+        self.batches = 0
+        self.blocked = 0  # enqueues that had to wait for room (backpressure)
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.max_depth = 0
+        self._thread = None
+
+    @staticmethod
+    def _record(user_id, sender, message, timestamp, kind, payload, attachments):
+        if timestamp is None:
+            ts = int(time.time())
+            timestamp = from_ts(ts)
+        else:
+            ts = to_ts(timestamp)
+        return (user_id, sender, message, timestamp, ts, kind, payload, attachments or ())
+
+    def _enqueued(self):
+        with self.cond:
+            self.enqueued += 1
+            depth = self.queue.qsize()
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+    def save(self, user_id, sender, message, timestamp=None, kind='text', payload=None, attachments=None):
+        """Queue a message row (and its attachments); blocks only while the queue is full."""
+        if self._thread is None:
+            self.start()
+        record = self._record(user_id, sender, message, timestamp, kind, payload, attachments)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.blocked += 1
+            self.queue.put(record)
+        self._enqueued()
+
+    async def save_async(self, user_id, sender, message, timestamp=None, kind='text', payload=None, attachments=None):
+        """Same as save() for async handlers: waits off the event loop when the queue is full."""
+        if self._thread is None:
+            self.start()
+        record = self._record(user_id, sender, message, timestamp, kind, payload, attachments)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.blocked += 1
+            await asyncio.to_thread(self.queue.put, record)
+        self._enqueued()
+
+    def flush(self, timeout=5):
+        """Wait until everything queued so far is committed (read-your-writes barrier)."""
+        with self.cond:
+            target = self.enqueued
+            return self.cond.wait_for(lambda: self.flushed + self.failed >= target, timeout=timeout)
+
+    def metrics(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_depth,
+            'queue_capacity': self.queue.maxsize,
+            'enqueued': self.enqueued,
+            'flushed': self.flushed,
+            'failed': self.failed,
+            'batches': self.batches,
+            'blocked_enqueues': self.blocked,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / self.batches, 2) if self.batches else 0.0,
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_batch_size': round(self.flushed / self.batches, 1) if self.batches else 0.0
+        }
+
+    def start(self):
+        with self.cond:
+            if self._thread is not None:
+                return self._thread
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+        return self._thread
+
+    def stop(self, timeout=10):
+        """Flush everything still queued and stop the writer thread."""
+        if self._thread is None:
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is _STOP:
+                return
+            batch = [first]
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    record = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stop = True
+                    break
+                batch.append(record)
+            self._flush(batch)
+            if stop:
+                # Drain whatever was queued behind the stop marker before exiting
+                rest = []
+                while True:
+                    try:
+                        rest.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if rest:
+                    self._flush([r for r in rest if r is not _STOP])
+                return
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        ok = True
+        ids = None
+        for attempt in range(3):
+            try:
+                ids = save_messages(batch)
+                break
+            except Exception as e:
+                print(f"Message writer flush failed (attempt {attempt + 1}): {e}")
+                time.sleep(0.2 * (attempt + 1))
+        else:
+            ok = False
+        elapsed = (time.perf_counter() - start) * 1000
+        with self.cond:
+            self.batches += 1
+            self.last_flush_ms = elapsed
+            self.total_flush_ms += elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            if ok:
+                self.flushed += len(batch)
+            else:
+                self.failed += len(batch)
+            self.cond.notify_all()
+        if ok and self.on_saved is not None:
+            try:
+                self.on_saved(list(zip(ids, batch)))
+            except Exception as e:
+                print(f"Message writer callback failed: {e}")